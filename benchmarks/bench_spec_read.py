@@ -0,0 +1,70 @@
+"""
+Compares the I/O of reading a multi-spectrum qid field by field (one read of
+the compound dataset per field, as done before) and in a single pass.
+
+Usage: python benchmarks/bench_spec_read.py [n_spectra] [n_pixels]
+"""
+import io
+import os
+import sys
+import time
+import tempfile
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import sdb  # noqa: E402
+import synthetic  # noqa: E402
+
+
+class CountingFile(io.FileIO):
+    """
+    A file object counting the bytes HDF5 reads through it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bytes_read = 0
+
+    def readinto(self, b):
+        n = super().readinto(b)
+        self.bytes_read += n
+        return n
+
+
+def read_per_field(qid, db):
+    # the reading pattern used before: the dataset is read once per field
+    spec_list = []
+    for group in db[qid]:
+        spec = {'wave': db[qid][group][:]['wave'],
+                'flux': db[qid][group][:]['flux'],
+                'sig': db[qid][group][:]['error']}
+        spec_list.append(spec)
+    return spec_list
+
+
+def measure(path, qid, reader):
+    with CountingFile(path, 'r') as fileobj:
+        with h5py.File(fileobj, 'r') as db:
+            start = time.perf_counter()
+            reader(qid, db)
+            elapsed = time.perf_counter() - start
+        return fileobj.bytes_read, elapsed
+
+
+def main(n_spectra=8, n_pixels=200000):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.hdf5")
+        meta = synthetic.make_qubrics_db(path, 1, spectra_per_object=n_spectra,
+                                         n_pixels=n_pixels)
+        qid = str(meta['qid'][0])
+        for name, reader in (("per field", read_per_field),
+                             ("single pass", sdb._qubrics_spec_by_qid)):
+            # warm up, so that lazy imports are not timed
+            measure(path, qid, reader)
+            bytes_read, elapsed = measure(path, qid, reader)
+            print(f"{name:>12}: {bytes_read / 2**20:8.1f} MiB read in {elapsed * 1e3:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main(*[int(_) for _ in sys.argv[1:]])
@@ -0,0 +1,185 @@
+"""
+Times the main `sdb`/`utils` operations on synthetic QUBRICS databases of
+increasing size and records the results as JSON, so that runs can be compared.
+
+Usage: python benchmarks/run.py [--sizes 1000 10000 ...] [-o results.json]
+                                [--compare baseline.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import numpy as np  # noqa: E402
+import h5py  # noqa: E402
+
+import sdb  # noqa: E402
+import utils  # noqa: E402
+import skyindex  # noqa: E402
+import columns  # noqa: E402
+import coadd  # noqa: E402
+import synthetic  # noqa: E402
+from config import config  # noqa: E402
+
+# objects with spectra in each synthetic database, searches only target them
+WITH_SPECTRA = 2000
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def coord_values(RA, DEC, radius):
+    return {'-RA_HMS-': "", '-DEC_DMS-': "", '-RA_DEC-': repr(float(RA)),
+            '-DEC_DEG-': repr(float(DEC)), '-MATCH_R-': str(radius), '-QID-': ""}
+
+
+def open_with_index(path):
+    # the sky index is only loaded (or built) by the first coordinate search
+    with sdb.QubricsDB(path) as db:
+        db.index
+
+
+def get_db(workdir, size):
+    path = os.path.join(workdir, f"qubrics_{size}.hdf5")
+    if not os.path.isfile(path):
+        start = time.perf_counter()
+        synthetic.make_qubrics_db(path, size, with_spectra=min(size, WITH_SPECTRA))
+        print(f"generated {path} in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+    return path
+
+
+def bench_size(path, repeat, rng):
+    """
+    Runs every benchmark on one database.
+
+    Returns:
+        dict: the list of timings (s) of each benchmark.
+    """
+    times = {}
+
+    # metadata loading, with the sky index built from scratch and reused
+    index_file = skyindex.index_path(path)
+    if os.path.isfile(index_file):
+        os.remove(index_file)
+    times["open_db (index build)"] = [timed(open_with_index, path)]
+    times["open_db"] = [timed(lambda: sdb.QubricsDB(path).close()) for _ in range(repeat)]
+    with h5py.File(path, 'r') as f:
+        times["read Metadata"] = [timed(lambda: f["Metadata"][:]) for _ in range(repeat)]
+    columns.write_columns(path)
+    try:
+        times["open_db (columns)"] = [timed(lambda: sdb.QubricsDB(path).close())
+                                      for _ in range(repeat)]
+    finally:
+        columns.main(["remove", path])
+
+    with sdb.QubricsDB(path) as db:
+        n_spectra = min(len(db.qid), WITH_SPECTRA)
+        targets = rng.integers(0, n_spectra, repeat)
+
+        times["_search_qubrics_by_coord"] = [
+            timed(sdb._search_qubrics_by_coord,
+                  coord_values(db.ra[i], db.dec[i], 2.), db, config)
+            for i in targets]
+        times["_search_qubrics_by_qid"] = [
+            timed(sdb._search_qubrics_by_qid, {'-QID-': str(db.qid[i])}, db, config)
+            for i in targets]
+
+        spectra = sdb._search_qubrics_by_qid({'-QID-': str(db.qid[0])}, db, config)[0]
+
+        # the spectra of the first objects, stacked per object
+        result = sdb.QubricsResult(db, np.arange(min(n_spectra, 200)))
+        spec_list, ids = list(result.iter_spectra()), result.object_ids()
+        grid = coadd.grid_for(spec_list)
+        times["coadd (200 objects)"] = [timed(coadd.coadd, spec_list, ids, grid)
+                                        for _ in range(repeat)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        times["write_spec"] = [
+            timed(utils.write_spec, spectra[0][0], os.path.join(tmp, "spec.fits"))
+            for _ in range(repeat)]
+
+        # Astrocook is replaced by a script doing nothing
+        noop = os.path.join(tmp, "noop.py")
+        with open(noop, "w") as f:
+            f.write("")
+        ac_path, config["ac_path"] = config.get("ac_path"), noop
+        try:
+            times["write_and_open"] = [timed(utils.write_and_open, spectra)
+                                       for _ in range(repeat)]
+        finally:
+            config["ac_path"] = ac_path
+            for (proc, _) in utils._ac_children:
+                proc.wait()
+            utils.shutdown_ac()
+    return times
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"date": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit,
+            "python": platform.python_version(), "numpy": np.__version__,
+            "h5py": h5py.__version__, "machine": platform.machine(),
+            "node": platform.node()}
+
+
+def compare(results, baseline):
+    base = {(_["size"], _["benchmark"]): _["median"] for _ in baseline["results"]}
+    print(f"{'size':>9} {'benchmark':<28} {'median (ms)':>12} {'baseline':>12} {'speedup':>8}")
+    for record in results["results"]:
+        key = (record["size"], record["benchmark"])
+        if key not in base:
+            continue
+        print(f"{record['size']:>9} {record['benchmark']:<28} {record['median'] * 1e3:12.2f} "
+              f"{base[key] * 1e3:12.2f} {base[key] / record['median']:8.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10**3, 10**4, 10**5, 10**6])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workdir", default=None,
+                        help="Where to keep the synthetic databases, to reuse them across runs.")
+    parser.add_argument("-o", "--output", default=None, help="JSON file for the results.")
+    parser.add_argument("--compare", default=None, help="JSON results to compare with.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # measure the searches, not the caches
+    sdb.spec_cache.resize(0)
+    config["result_cache_mb"] = 0
+    rng = np.random.default_rng(args.seed)
+    results = {"environment": environment(), "results": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        for size in args.sizes:
+            for name, times in bench_size(get_db(workdir, size), args.repeat, rng).items():
+                record = {"size": size, "benchmark": name, "times": times,
+                          "min": min(times), "median": statistics.median(times)}
+                results["results"].append(record)
+                print(f"{size:>9} {name:<28} {record['median'] * 1e3:10.2f} ms", file=sys.stderr)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Generates synthetic QUBRICS formatted databases for the benchmarks.
+
+The layout is the one `sdb` reads: a `Metadata` compound table with the qid
+in the first column and RA/DEC in the fifth and sixth, plus one group per qid
+holding a wave/flux/error compound dataset per spectrum.
+
+Usage: python benchmarks/synthetic.py OUTPUT N_OBJECTS [--with-spectra N] ...
+"""
+import argparse
+import h5py
+import numpy as np
+
+META_DTYPE = [('qid', 'i8'), ('NAME', 'S24'), ('ZEM', 'f8'), ('ZEM_SOURCE', 'S8'),
+              ('RA', 'f8'), ('DEC', 'f8'), ('INSTR', 'S12')]
+SPEC_DTYPE = [('wave', 'f8'), ('flux', 'f8'), ('error', 'f8')]
+
+
+def make_metadata(n_objects, seed=0):
+    """
+    Builds a `Metadata` table with objects uniformly distributed on the sky.
+
+    Args:
+        n_objects (int): number of rows.
+        seed (int, optional): random seed.
+
+    Returns:
+        ndarray: the structured array.
+    """
+    rng = np.random.default_rng(seed)
+    meta = np.zeros(n_objects, dtype=META_DTYPE)
+    meta['qid'] = np.arange(1, n_objects + 1) * 10
+    meta['NAME'] = np.char.add(b"SYN", meta['qid'].astype('S20'))
+    meta['ZEM'] = rng.uniform(0., 5., n_objects)
+    meta['ZEM_SOURCE'] = rng.choice([b'SDSS', b'BOSS', b'XQ100'], n_objects)
+    meta['RA'] = rng.uniform(0., 360., n_objects)
+    meta['DEC'] = np.degrees(np.arcsin(rng.uniform(-1., 1., n_objects)))
+    meta['INSTR'] = rng.choice([b'SDSS', b'XSHOOTER', b'UVES'], n_objects)
+    return meta
+
+
+def make_spectrum(n_pixels, rng, wave_min=3000., wave_max=10000.):
+    spec = np.empty(n_pixels, dtype=SPEC_DTYPE)
+    spec['wave'] = np.linspace(wave_min, wave_max, n_pixels)
+    spec['flux'] = rng.normal(1., 0.1, n_pixels)
+    spec['error'] = 0.1
+    return spec
+
+
+def make_qubrics_db(path, n_objects, with_spectra=None, spectra_per_object=2,
+                    n_pixels=4000, seed=0):
+    """
+    Writes a synthetic QUBRICS formatted database.
+
+    Args:
+        path (str): output file.
+        n_objects (int): number of objects in `Metadata`.
+        with_spectra (int, optional): number of objects (the first ones) that
+            get spectra. Defaults to None (all of them).
+        spectra_per_object (int, optional): spectra per object.
+        n_pixels (int, optional): pixels per spectrum.
+        seed (int, optional): random seed.
+
+    Returns:
+        ndarray: the `Metadata` table written.
+    """
+    rng = np.random.default_rng(seed)
+    meta = make_metadata(n_objects, seed)
+    if with_spectra is None:
+        with_spectra = n_objects
+
+    with h5py.File(path, 'w') as f:
+        f.create_dataset("Metadata", data=meta)
+        for qid in meta['qid'][:with_spectra]:
+            group = f.create_group(str(qid))
+            for n in range(spectra_per_object):
+                group.create_dataset(f"spec_{n}", data=make_spectrum(n_pixels, rng))
+    return meta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("output")
+    parser.add_argument("n_objects", type=int)
+    parser.add_argument("--with-spectra", type=int, default=None)
+    parser.add_argument("--spectra-per-object", type=int, default=2)
+    parser.add_argument("--n-pixels", type=int, default=4000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    make_qubrics_db(args.output, args.n_objects, args.with_spectra,
+                    args.spectra_per_object, args.n_pixels, args.seed)
+
+
+if __name__ == '__main__':
+    main()
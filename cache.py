@@ -0,0 +1,140 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SpectrumCache():
+    """
+    An in-memory LRU cache of loaded spectra, bounded by size.
+
+    Attributes:
+        max_bytes (int): the byte budget, 0 disables the cache.
+        size (int): bytes currently held.
+        hits (int): number of lookups found in the cache.
+        misses (int): number of lookups not found in the cache.
+        evictions (int): number of entries dropped to respect the budget.
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Returns a cached value, marking it as recently used.
+
+        Args:
+            key (tuple): the cache key.
+
+        Returns:
+            The cached value, or None if not found.
+        """
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, nbytes=None):
+        """
+        Adds a value to the cache, evicting the least recently used entries
+        if the budget is exceeded. Values larger than the budget are not stored.
+
+        Args:
+            key (tuple): the cache key.
+            value (obj): the value.
+            nbytes (int, optional): size of the value, estimated if None.
+
+        Returns:
+            None.
+        """
+        if nbytes is None:
+            nbytes = estimate_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.size += nbytes
+            self._evict()
+
+    def resize(self, max_bytes):
+        """
+        Changes the byte budget, evicting entries if needed.
+
+        Args:
+            max_bytes (int): the new budget.
+
+        Returns:
+            None.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """
+        Drops every entry, the counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: entries, size, budget, hits, misses and evictions.
+        """
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.size,
+                    "max_bytes": self.max_bytes, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.size -= nbytes
+            self.evictions += 1
+
+
+def estimate_nbytes(value):
+    """
+    Estimates the memory held by a spectrum, or a container of spectra.
+
+    Arrays are counted by size, objects through their `data` attribute (as
+    in `_SimpleSpec` and XSpectrum1D) and containers item by item.
+
+    Args:
+        value (obj): the value.
+
+    Returns:
+        int: the estimated size in bytes.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(_) for _ in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(_) for _ in value)
+    if hasattr(value, "data"):
+        return estimate_nbytes(value.data)
+    return 0
@@ -0,0 +1,208 @@
+from config import config, load_config
+
+import argparse
+import os
+import sys
+import log
+import utils
+import sdb
+import coadd
+import federated
+
+
+def make_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("db_file", metavar="DB", help="Path of the database, or 'all' to "
+                        "search every database of the configuration at once.")
+    common.add_argument("--qubrics", action="store_true",
+                        help="The database is QUBRICS formatted.")
+    common.add_argument("--config", default=None,
+                        help="Configuration file, defaults to config.yaml.")
+    common.add_argument("-o", "--output", default=None,
+                        help="Output file (or directory, for one FITS file per spectrum). "
+                             "Defaults to JSON lines on the standard output.")
+    common.add_argument("--format", choices=("fits", "hdf5", "json"), default=None,
+                        help="Output format, guessed from the output name if not given.")
+    common.add_argument("--stats", nargs="?", const="", default=None, metavar="FILE",
+                        help="Print the timings of searches, reads and writes at exit "
+                             "(to a JSON file if given).")
+
+    spectra = argparse.ArgumentParser(add_help=False)
+    spectra.add_argument("--wave-min", default="", help="Lower end of the wavelength range (Angstrom).")
+    spectra.add_argument("--wave-max", default="", help="Upper end of the wavelength range (Angstrom).")
+    spectra.add_argument("--rest-frame", action="store_true",
+                         help="The wavelength range is in the rest frame.")
+    spectra.add_argument("--coadd", action="store_true",
+                         help="Co-add the spectra of each object into one, weighting by "
+                              "inverse variance.")
+    spectra.add_argument("--dv", type=float, default=None,
+                         help="Pixel width (km/s) of the co-added spectra, defaults to "
+                              "the median one of the spectra.")
+
+    position = argparse.ArgumentParser(add_help=False)
+    position.add_argument("--ra", default="", help="RA, in degrees or as HH:MM:SS.")
+    position.add_argument("--dec", default="", help="DEC, in degrees or as DD:MM:SS.")
+    position.add_argument("--radius", default="1", help="Matching radius (arcsec).")
+
+    parser = argparse.ArgumentParser(
+        description="Search SpecDB and QUBRICS formatted databases without the GUI.")
+    sub = parser.add_subparsers(dest="mode", required=True)
+
+    qid = sub.add_parser("qid", parents=[common, spectra], help="Search by qid.")
+    qid.add_argument("qid")
+    sub.add_parser("coord", parents=[common, spectra, position],
+                   help="Search around a position.")
+    query = sub.add_parser("query", parents=[common, spectra, position],
+                           help="Search by metadata, optionally around a position.")
+    query.add_argument("query", help="e.g. 'ZEM=2.5:3.5; ZEM_SOURCE=SDSS,BOSS'")
+    batch = sub.add_parser("batch", parents=[common],
+                           help="Cross-match a target list, writes the match table.")
+    batch.add_argument("targets", help="Target list (CSV or FITS).")
+    batch.add_argument("--radius", default="", help="Matching radius (arcsec), "
+                       "if the target list has no radius column.")
+    return parser
+
+
+def parse_position(args):
+    """
+    Parses the position arguments, in degrees or sexagesimal.
+
+    Returns:
+        tuple: right ascension, declination and matching radius, as returned
+            by `utils.parse_input`.
+    """
+    if utils._is_number(args.ra):
+        return utils.parse_input("", "", args.ra, args.dec, args.radius)
+    return utils.parse_input(args.ra, args.dec, "", "", args.radius)
+
+
+def find(args, db, is_qubrics):
+    """
+    Finds the spectra of the search requested on the command line, without
+    reading them.
+
+    Returns:
+        SearchResult: the matches, see `sdb.SearchResult`.
+    """
+    wave_range = utils.parse_wave_range(args.wave_min, args.wave_max)
+    if args.mode == "qid":
+        return sdb.find_qid(args.qid, db, is_qubrics, wave_range, args.rest_frame)
+    if args.mode == "coord":
+        RA, DEC, tol = parse_position(args)
+        return sdb.find_coord(RA, DEC, tol, db, is_qubrics, wave_range, args.rest_frame)
+    cone = None
+    if args.ra != "" or args.dec != "":
+        RA, DEC, tol = parse_position(args)
+        cone = sdb._center_deg(RA, DEC) + (tol,)
+    return sdb.find_query(utils.parse_query(args.query), db, is_qubrics,
+                          cone, wave_range, args.rest_frame)
+
+
+def search(args, db, is_qubrics):
+    """
+    Runs the search requested on the command line.
+
+    Returns:
+        tuple: the spectra and their number, as returned by the `sdb` searches.
+    """
+    return find(args, db, is_qubrics).to_list()
+
+
+def write_spectra(spec_list, output, fmt, sources=None):
+    if output is None or fmt == "json":
+        if output is None:
+            utils.write_json(spec_list, sys.stdout, sources)
+            return
+        with open(output, "w") as f:
+            utils.write_json(spec_list, f, sources)
+        return
+
+    # spectra are written as they are read, except to FITS consolidated files
+    if os.path.isdir(output):
+        utils.write_specs(spec_list, os.path.join(output, ""))
+    else:
+        utils.write_consolidated(spec_list, output)
+
+
+def output_format(args):
+    if args.format is not None or args.output is None:
+        return args.format
+    if args.output.endswith((".hdf5", ".h5")):
+        return "hdf5"
+    if args.output.endswith(".json"):
+        return "json"
+    return "fits"
+
+
+def federated_search(args):
+    """
+    Runs the search requested on the command line on every configured database.
+    """
+    if args.mode == "batch":
+        sys.exit("Batch searches need a single database.")
+    if args.coadd:
+        sys.exit("Co-adding needs a single database.")
+    fed = federated.FederatedSearch.from_config(config)
+    try:
+        try:
+            result = fed.search(lambda db, is_qubrics, cancel: find(args, db, is_qubrics))
+        except utils.InvalidInput as e:
+            sys.exit(str(e))
+        print(result.summary(), file=sys.stderr)
+        print(f"Found {result.n_spec} spectra.", file=sys.stderr)
+        try:
+            if result.n_spec > 0:
+                write_spectra(result.iter_spectra(), args.output, output_format(args),
+                              result.sources)
+        finally:
+            result.release()
+    finally:
+        # the databases of timed out searches are closed once they finish,
+        #  their threads don't keep the program from exiting
+        fed.pool.close_all()
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    load_config(args.config)
+    log.dump_on_signal()
+    if args.stats is not None:
+        log.dump_at_exit(args.stats or None)
+    if args.db_file == "all":
+        return federated_search(args)
+
+    try:
+        db = sdb.open_db(args.db_file, args.qubrics)
+    except ModuleNotFoundError:
+        sys.exit("SpecDB is not installed: only QUBRICS formatted databases (--qubrics) can be searched.")
+
+    try:
+        if args.mode == "batch":
+            RA, DEC, tol = utils.parse_targets(args.targets, args.radius)
+            matches = sdb.batch_search(RA, DEC, tol, db, is_qubrics=args.qubrics)
+            print(f"Matched {len(set(matches['target']))} of {len(RA)} targets "
+                  f"({len(matches)} matches).", file=sys.stderr)
+            if args.output is None:
+                matches.write(sys.stdout, format="ascii.csv")
+            else:
+                matches.write(args.output, overwrite=True)
+        else:
+            result = find(args, db, args.qubrics)
+            print(f"Found {result.count()} spectra.", file=sys.stderr)
+            if result.count() > 0 and args.coadd:
+                spec_list, _ = coadd.coadd(result.iter_spectra(), result.object_ids(),
+                                           dv=args.dv)
+                print(f"Co-added into {len(spec_list)} spectra, one per object "
+                      "sorted by id.", file=sys.stderr)
+                write_spectra(spec_list, args.output, output_format(args))
+            elif result.count() > 0:
+                write_spectra(result.iter_spectra(), args.output, output_format(args))
+    except utils.InvalidInput as e:
+        sys.exit(str(e))
+    finally:
+        if isinstance(db, sdb.QubricsDB):
+            db.close()
+
+
+if __name__ == '__main__':
+    main()
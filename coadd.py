@@ -0,0 +1,382 @@
+import itertools
+import numpy as np
+
+import log
+import sdb
+import utils
+from lazy import lazy_import
+
+au = lazy_import("astropy.units")
+
+# speed of light (km/s), for grids with constant velocity pixels
+C_KMS = 299792.458
+
+# spectra resampled at a time by `coadd`, memory is about
+#  BATCH_SIZE * len(grid) * 80 bytes (small batches stay in the CPU cache)
+BATCH_SIZE = 64
+
+
+def _read_arrays(spec_list):
+    """
+    Concatenates the columns of several spectra, with wavelengths in Angstrom.
+
+    Units are converted once per distinct unit, not per spectrum.
+
+    Returns:
+        tuple: the wave, flux and err arrays of all the spectra one after the
+            other, the number of pixels of each spectrum and the set of their
+            flux units (as strings).
+    """
+    waves, fluxes, errs, to_aa, flux_units = [], [], [], {}, set()
+    for spec in spec_list:
+        wave = np.asarray(spec.data['wave'], dtype=np.float64).ravel()
+        unit = spec.units['wave']
+        if unit not in to_aa:
+            # no unit (an empty string) is taken as Angstrom
+            to_aa[unit] = au.Unit(unit).to(au.AA) if au.Unit(unit).to_string() else 1.
+        waves.append(wave * to_aa[unit] if to_aa[unit] != 1. else wave)
+        fluxes.append(np.asarray(spec.data['flux'], dtype=np.float64).ravel())
+        errs.append(np.asarray(spec.data['sig'], dtype=np.float64).ravel())
+        flux_units.add(spec.units['flux'])
+    flux_units = {au.Unit(_).to_string() for _ in flux_units}
+    lengths = np.array([len(_) for _ in waves], dtype=np.intp)
+    if not waves:
+        return np.empty(0), np.empty(0), np.empty(0), lengths, flux_units
+    return (np.concatenate(waves), np.concatenate(fluxes), np.concatenate(errs), lengths,
+            flux_units)
+
+
+def pixel_edges(wave, lengths=None):
+    """
+    Finds the pixel edges of one or more spectra from their pixel centres:
+    midpoints between pixels, and half a pixel out at the ends.
+
+    Args:
+        wave (ndarray): pixel centres, several spectra one after the other.
+        lengths (ndarray, optional): number of pixels of each spectrum (at
+            least 2). Defaults to a single spectrum.
+
+    Returns:
+        ndarray: the edges, `len(wave) + len(lengths)` of them, the ones of
+            each spectrum one after the other.
+    """
+    wave = np.asarray(wave, dtype=np.float64)
+    lengths = np.array([len(wave)] if lengths is None else lengths, dtype=np.intp)
+    left, width = _edges(wave, lengths)
+    ends = np.cumsum(lengths)
+    return np.insert(left, ends, left[ends - 1] + width[ends - 1])
+
+
+def _edges(wave, lengths):
+    # returns the left edge and the width of each pixel
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    left = np.empty_like(wave)
+    np.add(wave[:-1], wave[1:], out=left[1:])
+    left[1:] *= 0.5
+    left[starts] = 1.5 * wave[starts] - 0.5 * wave[starts + 1]
+    width = np.empty_like(wave)
+    np.subtract(left[1:], left[:-1], out=width[:-1])
+    width[ends - 1] = wave[ends - 1] - wave[ends - 2]
+    return left, width
+
+
+def wave_grid(wave_min, wave_max, dv=None, dwave=None):
+    """
+    Builds a common wavelength grid: pixels of constant velocity width
+    (logarithmic in wavelength) or of constant wavelength width.
+
+    Args:
+        wave_min (float): centre of the first pixel (Angstrom).
+        wave_max (float): the last pixel is the first one past it.
+        dv (float, optional): pixel width (km/s).
+        dwave (float, optional): pixel width (Angstrom), if `dv` isn't given.
+
+    Raises:
+        ValueError: If neither `dv` nor `dwave` is given, or the range is empty.
+
+    Returns:
+        ndarray: the pixel centres.
+    """
+    if not 0 < wave_min < wave_max:
+        raise ValueError(f"Invalid wavelength range {wave_min}-{wave_max}.")
+    if dv is not None:
+        step = np.log1p(dv / C_KMS)
+        n = int(np.ceil(np.log(wave_max / wave_min) / step)) + 1
+        return wave_min * np.exp(step * np.arange(n))
+    if dwave is not None:
+        n = int(np.ceil((wave_max - wave_min) / dwave)) + 1
+        return wave_min + dwave * np.arange(n)
+    raise ValueError("Either the velocity or the wavelength width of the pixels is needed.")
+
+
+def grid_for(spec_list, dv=None):
+    """
+    Builds a logarithmic grid covering a set of spectra.
+
+    Args:
+        spec_list (list): the spectrum objects.
+        dv (float, optional): pixel width (km/s). Defaults to the median pixel
+            width of the spectra.
+
+    Returns:
+        ndarray: the pixel centres, see `wave_grid`.
+    """
+    wave, _, _, lengths, _ = _read_arrays(spec_list)
+    lengths = lengths[lengths > 1]
+    if len(lengths) == 0:
+        raise ValueError("No spectrum with at least two pixels.")
+    wave = wave[np.isfinite(wave)]
+    if dv is None:
+        # the pixel steps across two spectra are negative or huge
+        steps = np.diff(np.log(wave))
+        dv = C_KMS * np.expm1(np.median(steps[steps > 0]))
+    return wave_grid(wave.min(), wave.max(), dv=dv)
+
+
+def _integrate(wave, flux, err, lengths, grid_edges):
+    # integrals of the good pixels of concatenated spectra over each bin of
+    #  the grid: covered width, flux and variance (partial pixels are
+    #  weighted by the fraction overlapping a bin, which slightly
+    #  overestimates the error), each of shape (spectra, grid pixels)
+    n_spec, n_edges = len(lengths), len(grid_edges)
+    usable = lengths > 1
+    if not np.all(usable):
+        out = np.zeros((3, n_spec, n_edges - 1))
+        if np.any(usable):
+            keep = np.repeat(usable, lengths)
+            out[:, usable] = _integrate(wave[keep], flux[keep], err[keep],
+                                        lengths[usable], grid_edges)
+        return out[0], out[1], out[2]
+
+    left, width = _edges(wave, lengths)
+    if not np.all(width > 0):
+        raise ValueError("The wavelengths of a spectrum must increase.")
+
+    # pixel of each spectrum holding each grid edge: the number of its left
+    #  edges up to the grid edge, less one and clipped to the spectrum. They
+    #  are counted with a histogram of the grid edge following each left
+    #  edge, found by np.interp (fast on increasing values); off by one at
+    #  most when the two coincide, which changes nothing below
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    after = np.interp(left, grid_edges, np.arange(n_edges, dtype=np.float64), right=n_edges)
+    bins = np.repeat(np.arange(n_spec) * (n_edges + 1), lengths)
+    bins += np.ceil(after, out=after).astype(np.intp)
+    pixel = np.bincount(bins, minlength=n_spec * (n_edges + 1)).reshape(n_spec, n_edges + 1)
+    pixel = np.cumsum(pixel[:, :-1], axis=1)
+    np.clip(pixel - 1, 0, (lengths - 1)[:, None], out=pixel)
+    pixel += starts[:, None]
+    # grid edges past the ends of a spectrum integrate up to its ends; `at`
+    #  is the part of the pixel past the grid edge, with a minus sign
+    right = left + width
+    clipped = np.clip(grid_edges, left[starts][:, None], right[ends - 1][:, None])
+    at = clipped - right[pixel]
+
+    # the integral up to a grid edge is the running sum of the pixel
+    #  integrals (density by width) through its pixel, less the part past
+    #  the edge; the running sums are over all the spectra, and their
+    #  offset at the start of each spectrum drops out of the differences.
+    #  Bad pixels have a zero density, and the coverage a unit one: without
+    #  bad pixels, it is the part of a bin within the spectrum
+    good = np.isfinite(flux) & np.isfinite(err) & (err > 0)
+    if np.all(good):
+        integrals = [np.diff(clipped, axis=1)]
+        densities = (flux, err * err * width)
+    else:
+        integrals = []
+        densities = (good.astype(np.float64), np.where(good, flux, 0.),
+                     np.where(good, err, 0.) ** 2 * width)
+    for density in densities:
+        integral = np.cumsum(density * width)[pixel]
+        integral += density[pixel] * at
+        integrals.append(np.diff(integral, axis=1))
+    return tuple(integrals)
+
+
+def _resample_arrays(wave, flux, err, lengths, grid_edges, min_coverage=0.5):
+    """
+    Flux-conserving resampling of concatenated spectra, see `resample`; the
+    grid is given by its pixel edges (see `pixel_edges`).
+    """
+    width, flux, var = _integrate(wave, flux, err, lengths, grid_edges)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covered = width >= min_coverage * np.diff(grid_edges)
+        covered &= width > 0
+        return (np.where(covered, flux / width, np.nan),
+                np.where(covered, np.sqrt(var) / width, np.nan))
+
+
+def resample(spec_list, grid, min_coverage=0.5):
+    """
+    Resamples spectra onto a common wavelength grid, conserving the flux:
+    each bin gets the mean flux of the input pixels over it, weighted by
+    overlap, and the matching error. Every spectrum is resampled at once.
+
+    Pixels with a non finite flux or error, or a non positive error, are
+    left out. Bins covered by good pixels for less than `min_coverage` of
+    their width are NaN.
+
+    Args:
+        spec_list (list): the spectrum objects.
+        grid (ndarray): the pixel centres of the grid (Angstrom), increasing.
+        min_coverage (float, optional): the least fraction of a bin to cover.
+
+    Raises:
+        ValueError: If the wavelengths of a spectrum don't increase.
+
+    Returns:
+        tuple: the flux and error arrays, of shape (spectra, grid pixels).
+    """
+    with log.timed("coadd.resample") as metrics:
+        flux, err, _ = _resample(spec_list, pixel_edges(grid), min_coverage)
+        metrics["rows"] = len(flux)
+        return flux, err
+
+
+def _resample(spec_list, grid_edges, min_coverage):
+    # also returns the flux units of the spectra
+    wave, flux, err, lengths, flux_units = _read_arrays(spec_list)
+    flux, err = _resample_arrays(wave, flux, err, lengths, grid_edges, min_coverage)
+    return flux, err, flux_units
+
+
+def stack(flux, err, labels=None):
+    """
+    Inverse-variance weighted mean of resampled spectra, pixel by pixel.
+
+    Args:
+        flux (ndarray): fluxes, of shape (spectra, grid pixels).
+        err (ndarray): errors, same shape, NaN where there is no data.
+        labels (ndarray, optional): the object of each spectrum, the spectra
+            of each object are stacked separately. Defaults to a single stack.
+
+    Returns:
+        tuple: the labels (sorted), the stacked flux and error and the number
+            of spectra used, of shape (labels, grid pixels); NaN where no
+            spectrum has data.
+    """
+    weight, weighted = _weights(flux, err)
+    labels, sum_w, sum_wf, n = _group_sums(weight, weighted, labels)
+    return (labels,) + _finish(sum_w, sum_wf, n)
+
+
+def _weights(flux, err):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight = 1. / err ** 2
+    weight[~(np.isfinite(weight) & np.isfinite(flux))] = 0.
+    return weight, np.where(weight > 0, weight * flux, 0.)
+
+
+def _group_sums(weight, weighted, labels):
+    # sums the rows of each label, sorted by label
+    if labels is None:
+        labels = np.zeros(len(weight), dtype=np.intp)
+    labels, groups = np.unique(np.asarray(labels), return_inverse=True)
+    groups = groups.ravel()
+    arrays = (weight, weighted, (weight > 0).astype(np.intp))
+    if np.any(np.diff(groups) < 0):
+        order = np.argsort(groups, kind="stable")
+        groups, arrays = groups[order], [_[order] for _ in arrays]
+    starts = np.searchsorted(groups, np.arange(len(labels)))
+    sums = [np.add.reduceat(_, starts, axis=0) for _ in arrays]
+    return (labels, *sums)
+
+
+def _label_sums(weight, weighted, labels):
+    # sums the rows of each label, in order of first appearance, as products
+    #  with an indicator matrix: a batch has few rows, and nothing is sorted
+    present = list(dict.fromkeys(labels))
+    ids = {label: n for n, label in enumerate(present)}
+    indicator = np.zeros((len(present), len(labels)))
+    indicator[[ids[_] for _ in labels], np.arange(len(labels))] = 1.
+    return present, indicator @ weight, indicator @ weighted, indicator @ (weight > 0)
+
+
+def _finish(sum_w, sum_wf, n):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        flux = np.where(n > 0, sum_wf / sum_w, np.nan)
+        err = np.where(n > 0, 1. / np.sqrt(sum_w), np.nan)
+    return flux, err, n
+
+
+@log.traced("coadd.coadd", rows=lambda result: len(result[1]))
+def coadd(spec_list, labels=None, grid=None, dv=None, min_coverage=0.5,
+          batch_size=BATCH_SIZE):
+    """
+    Co-adds spectra: resamples them onto a common grid (see `resample`) and
+    stacks them weighting by inverse variance (see `stack`).
+
+    The spectra are resampled `batch_size` at a time and summed as they go,
+    so `spec_list` can be a generator (e.g. `SearchResult.iter_spectra`) if
+    the grid is given.
+
+    Args:
+        spec_list (iterable): the spectrum objects.
+        labels (iterable, optional): the object of each spectrum (e.g. its
+            qid), one stack is made per object. Defaults to a single stack.
+        grid (ndarray, optional): the pixel centres of the grid (Angstrom).
+            Defaults to one covering all the spectra, see `grid_for`.
+        dv (float, optional): pixel width (km/s) of the default grid.
+        min_coverage (float, optional): see `resample`.
+        batch_size (int, optional): spectra resampled at a time.
+
+    Raises:
+        ValueError: If the spectra have different flux units, or the
+            wavelengths of a spectrum don't increase.
+
+    Returns:
+        tuple: the stacked spectra, one per object, and the objects (sorted);
+            each spectrum also has the number of spectra used per pixel in
+            `data['n']`.
+    """
+    if grid is None:
+        spec_list = list(spec_list)
+        grid = grid_for(spec_list, dv)
+    grid = np.asarray(grid, dtype=np.float64)
+    grid_edges = pixel_edges(grid)
+    min_width = np.maximum(min_coverage * np.diff(grid_edges), np.finfo(np.float64).tiny)
+    spec_iter = iter(spec_list)
+    label_iter = itertools.repeat(0) if labels is None else iter(labels)
+
+    totals, flux_units = {}, set()
+    while True:
+        batch = list(itertools.islice(spec_iter, batch_size))
+        if not batch:
+            break
+        batch_labels = [next(label_iter) for _ in batch]
+        with log.timed("coadd.resample") as metrics:
+            wave, flux, err, lengths, units = _read_arrays(batch)
+            width, flux, var = _integrate(wave, flux, err, lengths, grid_edges)
+            metrics["rows"] = len(batch)
+        flux_units |= units
+        # inverse variance weights of the resampled fluxes (flux / width,
+        #  error sqrt(var) / width), zero on the bins not covered enough
+        with np.errstate(divide="ignore"):
+            weighted = np.reciprocal(var, out=var)
+        weighted[width < min_width] = 0.
+        weighted *= width
+        weight = weighted * width
+        weighted *= flux
+        present, *sums = _label_sums(weight, weighted, batch_labels)
+        for n, label in enumerate(present):
+            if label in totals:
+                for total, _ in zip(totals[label], sums):
+                    total += _[n]
+            else:
+                totals[label] = [_[n] for _ in sums]
+
+    if len(flux_units) > 1:
+        raise ValueError(f"Can't co-add spectra with different flux units {sorted(flux_units)}.")
+    flux_unit = au.Unit(flux_units.pop()) if flux_units else au.dimensionless_unscaled
+    spec_list = []
+    for label in sorted(totals):
+        sum_w, sum_wf, n = totals[label]
+        flux, err, n = _finish(sum_w, sum_wf, n.astype(np.intp))
+        spec = sdb._SimpleSpec()
+        spec.data['wave'], spec.data['flux'], spec.data['sig'] = grid, flux, err
+        spec.data['n'] = n
+        spec.units['wave'] = au.AA
+        spec.units['flux'] = spec.units['sig'] = flux_unit
+        spec_list.append(spec)
+    return spec_list, (sorted(totals) if labels is not None else [None] * len(spec_list))
@@ -0,0 +1,149 @@
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+
+import log
+import skyindex
+from lazy import lazy_import
+
+h5py = lazy_import("h5py")
+
+COLUMNS_SUFFIX = ".columns"
+MANIFEST = "manifest.json"
+
+
+def columns_path(db_file):
+    """
+    Returns the path of the column sidecar of a database.
+
+    Args:
+        db_file (str): path of the database.
+
+    Returns:
+        str: path of the sidecar directory.
+    """
+    return db_file + COLUMNS_SUFFIX
+
+
+def write_columns(db_file, meta=None):
+    """
+    Writes the `Metadata` of a database as a column sidecar: a directory next
+    to the database with one `.npy` file per column, plus the order sorting
+    the qids, that can be memory-mapped.
+
+    The sidecar is written to a temporary directory and swapped in, so that
+    readers never see a partial one; processes still mapping the previous
+    files keep reading them until they reopen the database.
+
+    Args:
+        db_file (str): path of the database.
+        meta (ndarray, optional): the `Metadata` table, if already in memory.
+
+    Raises:
+        ValueError: If a column can't be memory-mapped (e.g. variable length
+            strings).
+
+    Returns:
+        str: path of the sidecar directory.
+    """
+    stamp = skyindex.db_stamp(db_file)
+    if meta is None:
+        with h5py.File(db_file, 'r') as db:
+            meta = db["Metadata"][:]
+    names = meta.dtype.names
+    if any(meta.dtype[name].hasobject for name in names):
+        raise ValueError(f"{db_file}: Metadata has columns that can't be memory-mapped.")
+
+    path = columns_path(db_file)
+    tmp_path, old_path = path + ".tmp", path + ".old"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for n, name in enumerate(names):
+        # h5py tags string types with metadata that .npy files can't store
+        column = np.ascontiguousarray(meta[name])
+        np.save(os.path.join(tmp_path, f"{n:03}.npy"), column.view(np.dtype(column.dtype.str)))
+    np.save(os.path.join(tmp_path, "qid_order.npy"),
+            np.argsort(meta[names[0]], kind="stable"))
+    with open(os.path.join(tmp_path, MANIFEST), "w") as f:
+        json.dump({"names": list(names), "stamp": list(stamp)}, f)
+
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.isdir(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return path
+
+
+def load_columns(db_file):
+    """
+    Memory-maps the column sidecar of a database, if it has one.
+
+    A sidecar that doesn't match the database anymore is rebuilt: having
+    one means it was asked for.
+
+    Args:
+        db_file (str): path of the database.
+
+    Returns:
+        tuple: the columns (read-only memory maps) by name, in order, and
+            the order sorting the qids; None if there is no usable sidecar.
+    """
+    path = columns_path(db_file)
+    if not os.path.isdir(path):
+        return None
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        if tuple(manifest["stamp"]) != skyindex.db_stamp(db_file):
+            log.logger.warning(f"Rebuilding stale column sidecar {path}.")
+            write_columns(db_file)
+            with open(os.path.join(path, MANIFEST)) as f:
+                manifest = json.load(f)
+        meta = {name: np.load(os.path.join(path, f"{n:03}.npy"), mmap_mode='r')
+                for n, name in enumerate(manifest["names"])}
+        qid_order = np.load(os.path.join(path, "qid_order.npy"), mmap_mode='r')
+    except (OSError, KeyError, ValueError) as e:
+        log.logger.warning(f"Ignoring unusable column sidecar {path}: {e}")
+        return None
+    return meta, qid_order
+
+
+def refresh_columns(db_file, meta=None):
+    """
+    Rebuilds the column sidecar of a database after a change, if it has one.
+
+    Args:
+        db_file (str): path of the database.
+        meta (ndarray, optional): the new `Metadata` table, if in memory.
+
+    Returns:
+        None.
+    """
+    if os.path.isdir(columns_path(db_file)):
+        write_columns(db_file, meta)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Manage the memory-mapped Metadata columns of QUBRICS formatted databases.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser(
+        "build", help="Write (or rewrite) the column sidecar of the given databases.")
+    build.add_argument("db_files", nargs="+", metavar="FILE")
+    remove = sub.add_parser(
+        "remove", help="Remove the column sidecar, the databases read Metadata from HDF5 again.")
+    remove.add_argument("db_files", nargs="+", metavar="FILE")
+    args = parser.parse_args(argv)
+
+    for db_file in args.db_files:
+        if args.command == "build":
+            print(write_columns(db_file))
+        elif args.command == "remove":
+            shutil.rmtree(columns_path(db_file), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import os
+import threading
+from collections import OrderedDict
+
+import log
+import sdb
+import skyindex
+
+
+def close_db(db):
+    """
+    Closes a SpecDB or QUBRICS database object.
+    """
+    if isinstance(db, sdb.QubricsDB):
+        db.close()
+    elif getattr(db, "hdf", None) is not None:
+        # SpecDB keeps its file open as `hdf`
+        db.hdf.close()
+
+
+class Lease():
+    """
+    A database taken from a `DatabasePool`: the pool doesn't close it until
+    it is released, even if it gets evicted or its file changes meanwhile.
+    Can be used as a context manager, giving the database.
+
+    Attributes:
+        db (SpecDB or QubricsDB): the database object.
+    """
+
+    def __init__(self, pool, db):
+        self.db = db
+        self._pool = pool
+        self._released = False
+
+    def release(self):
+        """
+        Gives the database back to the pool, only the first call counts.
+        """
+        if not self._released:
+            self._released = True
+            self._pool._release(self.db)
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class DatabasePool():
+    """
+    The databases opened so far, kept open to switch between them instantly.
+
+    Databases are keyed by path and format, and reopened if the file changed
+    (see `skyindex.db_stamp`). When more than `max_open` are open the least
+    recently used one is dropped. Databases taken with `lease` are only
+    closed once every lease is released: whoever keeps using a database (a
+    search running on a thread, results read later) should lease it.
+
+    Attributes:
+        max_open (int): the most databases kept open.
+    """
+
+    def __init__(self, max_open=4):
+        self.max_open = max_open
+        self._dbs = OrderedDict()
+        self._lock = threading.Lock()
+        self._opening = {}
+        # leases of each database, by id, and the dropped ones still leased
+        self._leases = {}
+        self._retired = {}
+
+    def get(self, db_file, is_qubrics=False):
+        """
+        Returns a database, opening it if needed.
+
+        The database can be closed by a later call that evicts it, use
+        `lease` to keep using it.
+
+        Args:
+            db_file (str): path of the database.
+            is_qubrics (bool, optional): whether the database is QUBRICS formatted.
+
+        Raises:
+            ModuleNotFoundError: If the database is a SpecDB one but SpecDB is
+                not installed.
+
+        Returns:
+            SpecDB or QubricsDB: the database object.
+        """
+        return self._get(db_file, is_qubrics, False)
+
+    def lease(self, db_file, is_qubrics=False):
+        """
+        Takes a database, opening it if needed, see `get`.
+
+        Returns:
+            Lease: the database, to release once done with it.
+        """
+        return Lease(self, self._get(db_file, is_qubrics, True))
+
+    def _get(self, db_file, is_qubrics, leased):
+        key = (os.path.realpath(db_file), bool(is_qubrics))
+        stamp = skyindex.db_stamp(db_file)
+        with self._lock:
+            opening = self._opening.setdefault(key, threading.Lock())
+
+        # one thread opens a database, the others asking for it wait
+        closing = []
+        try:
+            with opening:
+                with self._lock:
+                    if key in self._dbs:
+                        db, db_stamp = self._dbs[key]
+                        if db_stamp == stamp:
+                            self._dbs.move_to_end(key)
+                            if leased:
+                                self._leases[id(db)] = self._leases.get(id(db), 0) + 1
+                            return db
+                        del self._dbs[key]
+                        closing += self._retire([db])
+                db = sdb.open_db(db_file, is_qubrics)
+                with self._lock:
+                    self._dbs[key] = (db, stamp)
+                    if leased:
+                        self._leases[id(db)] = self._leases.get(id(db), 0) + 1
+                    evicted = []
+                    while len(self._dbs) > max(self.max_open, 1):
+                        evicted.append(self._dbs.popitem(last=False)[1][0])
+                    closing += self._retire(evicted)
+                return db
+        finally:
+            for old in closing:
+                close_db(old)
+
+    def _retire(self, dbs):
+        # keeps the leased databases aside, returns the ones to close
+        closing = []
+        for db in dbs:
+            if self._leases.get(id(db), 0) > 0:
+                self._retired[id(db)] = db
+            else:
+                closing.append(db)
+        return closing
+
+    def _release(self, db):
+        with self._lock:
+            count = self._leases.pop(id(db), 0) - 1
+            if count > 0:
+                self._leases[id(db)] = count
+                return
+            db = self._retired.pop(id(db), None)
+        if db is not None:
+            close_db(db)
+
+    def prewarm(self, databases):
+        """
+        Opens databases in the background, so that they are ready when needed.
+
+        Args:
+            databases (list): (path, is_qubrics) of each database, the most
+                important last: only the last `max_open` stay open.
+
+        Returns:
+            threading.Thread: the thread opening them.
+        """
+        def run():
+            for db_file, is_qubrics in databases:
+                try:
+                    self.get(db_file, is_qubrics)
+                except Exception as e:
+                    log.logger.warning(f"Could not open {db_file} in advance: {e}")
+
+        thread = threading.Thread(target=run, daemon=True, name="prewarm")
+        thread.start()
+        return thread
+
+    def close_all(self):
+        """
+        Closes every database (e.g. at exit). The leased ones are closed
+        when their last lease is released, so that searches still running
+        (e.g. timed out ones) don't see them closed under them.
+        """
+        with self._lock:
+            dbs = self._retire([db for (db, _) in self._dbs.values()])
+            self._dbs.clear()
+        for db in dbs:
+            close_db(db)
+
+
+# the databases opened by the GUI, see `max_open_dbs` in `config.yaml`
+pool = DatabasePool()
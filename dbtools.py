@@ -0,0 +1,459 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import numpy as np
+
+import log
+import sdb
+import columns
+import skyindex
+from config import config
+from utils import InvalidInput
+from lazy import lazy_import
+
+h5py = lazy_import("h5py")
+
+# group holding an update until it is swapped in
+STAGING = "_staging"
+# root attribute recording an update in progress: "staging" or "committing"
+STATE_ATTR = "update_state"
+# staged `Metadata` rows: appended, replaced and the rows they replace, and
+#  the attribute with the size of the table before the update
+META_APPENDED = "Metadata_appended"
+META_REPLACED = "Metadata_replaced"
+META_ROWS = "Metadata_rows"
+META_SIZE = "metadata_size"
+META_NAMES = ("Metadata", META_APPENDED, META_REPLACED, META_ROWS)
+
+# datasets up to this size are stored in the object header (HDF5 allows 64 kB)
+COMPACT_MAX_BYTES = 60000
+# target size of the chunks of the repacked datasets
+CHUNK_BYTES = 1 << 20
+
+
+def _layout(dset):
+    """
+    Returns the creation keywords reproducing the storage layout of a dataset.
+    """
+    if dset.chunks is None:
+        return {}
+    return {"chunks": dset.chunks, "maxshape": dset.maxshape,
+            "compression": dset.compression, "compression_opts": dset.compression_opts,
+            "shuffle": dset.shuffle, "fletcher32": dset.fletcher32}
+
+
+def _match_rows(meta, new_meta):
+    """
+    Returns the row of each qid of `new_meta` in `meta` (0 if missing) and
+    whether it is there.
+    """
+    qid, new_qid = meta[meta.dtype.names[0]], new_meta[meta.dtype.names[0]]
+    rows = np.zeros(len(new_qid), dtype=np.intp)
+    found = np.zeros(len(new_qid), dtype=bool)
+    if len(qid):
+        order = np.argsort(qid, kind="stable")
+        pos = np.searchsorted(qid, new_qid, sorter=order)
+        rows = order[np.minimum(pos, len(qid) - 1)]
+        found = qid[rows] == new_qid
+    return rows, found
+
+
+def merge_metadata(meta, new_meta, replace=True):
+    """
+    Merges the `Metadata` rows of an update into the existing ones.
+
+    Rows whose qid is already in `meta` are replaced in place (or left alone
+    if `replace` is False), the others are appended, in their order.
+
+    Args:
+        meta (ndarray): the current `Metadata` table.
+        new_meta (ndarray): the rows of the update, with the same columns.
+        replace (bool, optional): replace the rows already present.
+
+    Raises:
+        InvalidInput: If the columns of the two tables differ.
+
+    Returns:
+        tuple: the merged table and the qids (as strings) added, replaced
+            and skipped.
+    """
+    if meta.dtype.names != new_meta.dtype.names:
+        raise InvalidInput(f"The columns of the update {new_meta.dtype.names} "
+                           f"don't match the database {meta.dtype.names}.")
+    new_meta = new_meta.astype(meta.dtype)
+    rows, found = _match_rows(meta, new_meta)
+
+    merged = meta.copy()
+    if replace:
+        merged[rows[found]] = new_meta[found]
+    merged = np.concatenate([merged, new_meta[~found]])
+
+    new_str = new_meta[meta.dtype.names[0]].astype("str")
+    replaced = list(new_str[found]) if replace else []
+    skipped = [] if replace else list(new_str[found])
+    return merged, list(new_str[~found]), replaced, skipped
+
+
+def _meta_layout(meta):
+    """
+    Returns the creation keywords of a `Metadata` table that updates can
+    resize: uncompressed chunks of about `CHUNK_BYTES`, so that reading it
+    whole is about as fast as reading a contiguous one.
+    """
+    rows = max(1, min(max(len(meta), 1), CHUNK_BYTES // max(1, meta.dtype.itemsize)))
+    return {"chunks": (rows,), "maxshape": (None,)}
+
+
+def _stage(db, new, new_meta, replace):
+    """
+    Copies the groups of an update into `STAGING`, with the `Metadata` rows
+    to append (`META_APPENDED`) and to replace (`META_REPLACED`, at the rows
+    `META_ROWS`).
+
+    A `Metadata` table that can't be resized (e.g. written by
+    `pbuild.write_hdf`) is copied once into `STAGING` as a resizable one.
+    """
+    meta_dset = db["Metadata"]
+    meta = meta_dset[:]
+    merged, added, replaced, skipped = merge_metadata(meta, new_meta, replace)
+    new_meta = new_meta.astype(meta.dtype)
+    rows, found = _match_rows(meta, new_meta)
+
+    staging = db.create_group(STAGING)
+    for qid in added + replaced:
+        if qid in new:
+            new.copy(new[qid], staging, name=qid)
+    if meta_dset.maxshape[0] is not None:
+        log.logger.warning(f"Making the Metadata of {db.filename} resizable, "
+                           "its current copy is left unused (see `repack`).")
+        staging.create_dataset("Metadata", data=meta, **_meta_layout(meta))
+    staging.attrs[META_SIZE] = len(meta)
+    staging.create_dataset(META_APPENDED, data=new_meta[~found])
+    # the last row of a qid repeated in the update wins, as in `merge_metadata`
+    rows, last = np.unique(rows[found][::-1] if replace else rows[:0], return_index=True)
+    staging.create_dataset(META_ROWS, data=rows)
+    staging.create_dataset(META_REPLACED, data=new_meta[found][::-1][last])
+    return merged, added, replaced, skipped
+
+
+def _commit(db):
+    """
+    Swaps the staged groups in and writes the staged `Metadata` rows.
+
+    Every step only moves links or writes the same rows again, so an
+    interrupted commit is completed by running it again, also once `STAGING`
+    itself is gone.
+    """
+    if STAGING not in db:
+        del db.attrs[STATE_ATTR]
+        return
+    staging = db[STAGING]
+    for name in [_ for _ in staging if _ not in META_NAMES]:
+        if name in db:
+            del db[name]
+        db.move(f"{STAGING}/{name}", name)
+    if "Metadata" in staging:
+        if "Metadata" in db:
+            del db["Metadata"]
+        db.move(f"{STAGING}/Metadata", "Metadata")
+    if META_SIZE in staging.attrs:
+        meta, size = db["Metadata"], int(staging.attrs[META_SIZE])
+        appended = staging[META_APPENDED][:]
+        meta.resize((size + len(appended),))
+        if len(appended):
+            meta[size:] = appended
+        rows = staging[META_ROWS][:]
+        if len(rows):
+            meta[rows] = staging[META_REPLACED][:]
+    del db[STAGING]
+    del db.attrs[STATE_ATTR]
+
+
+def recover(db):
+    """
+    Completes or discards an interrupted update of an open database.
+
+    An update interrupted while staging is discarded, the database being
+    still untouched; one interrupted while committing is completed.
+
+    Args:
+        db (h5py.File): the database, open for writing.
+
+    Returns:
+        str: the state of the interrupted update, or None if there was none.
+    """
+    state = db.attrs.get(STATE_ATTR)
+    if state is None:
+        return None
+    if isinstance(state, bytes):
+        state = state.decode()
+    if state == "committing":
+        _commit(db)
+    else:
+        if STAGING in db:
+            del db[STAGING]
+        del db.attrs[STATE_ATTR]
+    log.logger.warning(f"Recovered interrupted update of {db.filename} ({state}).")
+    return state
+
+
+def update_db(db_file, new_file, replace=True):
+    """
+    Adds the objects of a QUBRICS formatted file to an existing database.
+
+    The qid groups of `new_file` are copied, with its `Metadata` rows: qids
+    not yet in the database are appended, the others replace the current
+    ones (unless `replace` is False). Only the new groups and rows are
+    written: `Metadata` is resized and written in place (the first update of
+    a table that can't be resized copies it once). The space of replaced
+    groups is only reclaimed by `repack`. If there is nothing to add or
+    replace the database is not opened for writing.
+
+    The update is first staged inside the database and then swapped in by
+    moving links and writing the staged rows; the state is recorded in the
+    file, so that an update interrupted by an exception, or by a kill after
+    a state was flushed, is rolled back or completed by the next one (or by
+    `recover`). The sky index (and the column sidecar, if any) is rebuilt at
+    the end.
+
+    This is not atomic: the file is modified in place, and a crash (kill -9,
+    power loss) while HDF5 is writing its own metadata can still leave it
+    unreadable. Keep a copy of databases that can't be rebuilt.
+
+    Args:
+        db_file (str): path of the database to update.
+        new_file (str): QUBRICS formatted file with the objects to add.
+        replace (bool, optional): replace the qids already in the database.
+
+    Raises:
+        InvalidInput: If the `Metadata` columns of the two files differ.
+
+    Returns:
+        tuple: the qids (as strings) added, replaced and skipped.
+    """
+    with h5py.File(new_file, 'r') as new:
+        new_meta = new["Metadata"][:]
+        with h5py.File(db_file, 'r') as db:
+            unfinished = STATE_ATTR in db.attrs
+            merged, added, replaced, skipped = merge_metadata(
+                db["Metadata"][:], new_meta, replace)
+        if not (added or replaced or unfinished):
+            return added, replaced, skipped
+
+        with h5py.File(db_file, 'r+') as db:
+            recover(db)
+            db.attrs[STATE_ATTR] = "staging"
+            db.flush()
+            merged, added, replaced, skipped = _stage(db, new, new_meta, replace)
+            db.attrs[STATE_ATTR] = "committing"
+            db.flush()
+            _commit(db)
+            db.flush()
+
+    skyindex.rebuild_index(db_file, merged)
+    columns.refresh_columns(db_file, merged)
+    return added, replaced, skipped
+
+
+def _write_compact(group, name, data):
+    dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    dcpl.set_layout(h5py.h5d.COMPACT)
+    tid = h5py.h5t.py_create(data.dtype, logical=True)
+    space = h5py.h5s.create_simple(data.shape)
+    dset = h5py.h5d.create(group.id, name.encode(), tid, space, dcpl=dcpl)
+    dset.write(h5py.h5s.ALL, h5py.h5s.ALL, data)
+    return group[name]
+
+
+def _repack_dataset(src, group, name, compression, level, shuffle, compact_max):
+    """
+    Copies a dataset with the layout chosen for how `sdb` reads it.
+
+    `Metadata` is read whole, column by column: it is stored in large
+    uncompressed chunks, resizable so that updates append to it. Small
+    datasets (most spectra) are stored compact, in the object header, so a
+    qid group is read without seeking to separate data blocks. The others
+    are chunked and compressed, one chunk of about `CHUNK_BYTES` holding a
+    whole spectrum or a run of rows, and copied a few chunks at a time.
+    """
+    if name == "Metadata" and group.name == "/":
+        data = src[()]
+        dset = group.create_dataset(name, data=data, **_meta_layout(data))
+    elif src.ndim == 0:
+        dset = group.create_dataset(name, data=src[()])
+    elif src.nbytes <= compact_max:
+        dset = _write_compact(group, name, src[()])
+    else:
+        row_bytes = max(1, src.nbytes // src.shape[0])
+        chunks = (max(1, min(src.shape[0], CHUNK_BYTES // row_bytes)),) + src.shape[1:]
+        dset = group.create_dataset(
+            name, shape=src.shape, dtype=src.dtype, chunks=chunks,
+            compression=compression, shuffle=shuffle and compression is not None,
+            compression_opts=level if compression == "gzip" else None)
+        step = chunks[0] * 16
+        for start in range(0, src.shape[0], step):
+            dset[start:start + step] = src[start:start + step]
+    for key, value in src.attrs.items():
+        dset.attrs[key] = value
+
+
+def _repack_group(src, dst, **options):
+    for key, value in src.attrs.items():
+        dst.attrs[key] = value
+    for name, obj in src.items():
+        if isinstance(obj, h5py.Group):
+            _repack_group(obj, dst.create_group(name), **options)
+        else:
+            _repack_dataset(obj, dst, name, **options)
+
+
+def repack(db_file, out_file, compression="gzip", level=4, shuffle=True,
+           compact_max=COMPACT_MAX_BYTES):
+    """
+    Rewrites a QUBRICS formatted database with a layout tuned for the searches.
+
+    The copy is written next to `out_file` and renamed when complete, so it
+    can't be mistaken for a finished one. Space left unused by updates is not
+    copied.
+
+    Args:
+        db_file (str): path of the database.
+        out_file (str): path of the repacked database.
+        compression (str, optional): "gzip", "lzf" or None.
+        level (int, optional): gzip compression level.
+        shuffle (bool, optional): apply the shuffle filter before compressing.
+        compact_max (int, optional): largest dataset (bytes) stored compact.
+
+    Raises:
+        InvalidInput: If the database has an unfinished update.
+
+    Returns:
+        None.
+    """
+    tmp_file = out_file + ".tmp"
+    with h5py.File(db_file, 'r') as src:
+        if STATE_ATTR in src.attrs:
+            raise InvalidInput(f"{db_file} has an unfinished update, "
+                               "run `dbtools.py recover` first.")
+        with h5py.File(tmp_file, 'w') as dst:
+            _repack_group(src, dst, compression=compression, level=level,
+                          shuffle=shuffle, compact_max=compact_max)
+    os.replace(tmp_file, out_file)
+    skyindex.rebuild_index(out_file)
+
+
+def measure_latency(db_file, n_searches=50, radius=2., seed=0):
+    """
+    Times opening a database and searching it with the `sdb` searches.
+
+    The objects searched are chosen (at random) among those with spectra,
+    the same in every database with the same contents, so that a database
+    and its repacked copy can be compared.
+    The spectrum cache and the search result cache (see `resultcache`) are
+    disabled while measuring.
+
+    Args:
+        db_file (str): path of the database.
+        n_searches (int, optional): number of qid and coordinate searches.
+        radius (float, optional): radius of the coordinate searches (arcsec).
+        seed (int, optional): random seed choosing the objects.
+
+    Returns:
+        dict: time (s) to open the database and median time of each search.
+    """
+    budget = sdb.spec_cache.max_bytes
+    result_budget = config.get("result_cache_mb", 64)
+    sdb.spec_cache.resize(0)
+    config["result_cache_mb"] = 0
+    try:
+        start = time.perf_counter()
+        db = sdb.QubricsDB(db_file)
+        times = {"open": time.perf_counter() - start}
+        with db:
+            # the groups of the qids with spectra (`Metadata` has no row): those
+            #  of a sparse database would be missed sampling the rows
+            rows = []
+            for qid in np.random.default_rng(seed).permutation(sorted(db.file)):
+                try:
+                    rows.append(db.row(qid))
+                except KeyError:
+                    continue
+                if len(rows) == n_searches:
+                    break
+            for name, search in [
+                    ("search_qid", lambda row: sdb.search_qid(db.qid[row], db, True)),
+                    ("search_coord", lambda row: sdb.search_coord(
+                        db.ra[row], db.dec[row], radius, db, True))]:
+                elapsed = []
+                for row in rows:
+                    start = time.perf_counter()
+                    search(row)
+                    elapsed.append(time.perf_counter() - start)
+                times[name] = statistics.median(elapsed) if elapsed else float("nan")
+    finally:
+        sdb.spec_cache.resize(budget)
+        config["result_cache_mb"] = result_budget
+    return times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Maintenance of QUBRICS formatted databases.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    update = sub.add_parser(
+        "update", help="Append (or replace) the objects of another QUBRICS formatted file.")
+    update.add_argument("db_file", metavar="DB")
+    update.add_argument("new_file", metavar="NEW")
+    update.add_argument("--no-replace", action="store_true",
+                        help="Keep the qids already in the database.")
+    recover_cmd = sub.add_parser(
+        "recover", help="Complete or discard an interrupted update.")
+    recover_cmd.add_argument("db_file", metavar="DB")
+    repack_cmd = sub.add_parser(
+        "repack", help="Rewrite a database with chunking and compression tuned for the searches.")
+    repack_cmd.add_argument("db_file", metavar="DB")
+    repack_cmd.add_argument("out_file", metavar="OUT")
+    repack_cmd.add_argument("--compression", choices=("gzip", "lzf", "none"), default="gzip")
+    repack_cmd.add_argument("--level", type=int, default=4, help="gzip compression level.")
+    repack_cmd.add_argument("--no-shuffle", action="store_true",
+                            help="Don't apply the shuffle filter.")
+    repack_cmd.add_argument("--compact-max", type=int, default=COMPACT_MAX_BYTES,
+                            help="Largest dataset (bytes) stored compact, 0 to disable.")
+    repack_cmd.add_argument("--searches", type=int, default=50,
+                            help="Searches timed on each file, 0 to skip.")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "update":
+            added, replaced, skipped = update_db(args.db_file, args.new_file,
+                                                 not args.no_replace)
+            print(f"{args.db_file}: {len(added)} added, {len(replaced)} replaced, "
+                  f"{len(skipped)} skipped")
+        elif args.command == "recover":
+            with h5py.File(args.db_file, 'r+') as db:
+                state = recover(db)
+            print(f"{args.db_file}: " + ("nothing to recover" if state is None
+                                          else f"recovered update ({state})"))
+            if state is not None:
+                skyindex.rebuild_index(args.db_file)
+        elif args.command == "repack":
+            compression = None if args.compression == "none" else args.compression
+            repack(args.db_file, args.out_file, compression, args.level,
+                   not args.no_shuffle, args.compact_max)
+            print(f"{'':18} {'before':>12} {'after':>12}")
+            print(f"{'size (MB)':18} {os.path.getsize(args.db_file) / 1e6:12.1f} "
+                  f"{os.path.getsize(args.out_file) / 1e6:12.1f}")
+            if args.searches > 0:
+                before = measure_latency(args.db_file, args.searches)
+                after = measure_latency(args.out_file, args.searches)
+                for name in before:
+                    print(f"{name + ' (ms)':18} {before[name] * 1e3:12.2f} "
+                          f"{after[name] * 1e3:12.2f}")
+    except InvalidInput as e:
+        sys.exit(str(e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+import os
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, TimeoutError
+
+import numpy as np
+
+import log
+import sdb
+import utils
+import dbpool
+
+# what one database returned: result is its `sdb.SearchResult` (None if it
+#  failed), n_spec the spectra matched, error the exception raised (or a
+#  TimeoutError), elapsed the time taken (s) and lease what keeps the
+#  database open while the spectra are read
+SourceResult = namedtuple("SourceResult", ["name", "db_file", "n_spec", "result",
+                                           "error", "elapsed", "lease"])
+
+
+class FederatedResult(sdb.SearchResult):
+    """
+    The merged results of a search over several databases, read a page at a
+    time like those of a single database.
+
+    The databases stay open until `release` is called.
+
+    Attributes:
+        by_source (dict): the `SourceResult` of each database, by name.
+        sources (list): the name of the database each spectrum comes from,
+            in the order of the databases.
+    """
+
+    def __init__(self, results):
+        self.by_source = {_.name: _ for _ in results}
+        self.sources = np.repeat([_.name for _ in results],
+                                 [_.n_spec for _ in results]).tolist()
+
+    @property
+    def n_spec(self):
+        return len(self.sources)
+
+    def count(self):
+        return self.n_spec
+
+    def _matched(self):
+        return [_ for _ in self.by_source.values() if _.result is not None and _.n_spec]
+
+    def object_ids(self):
+        ids = [np.asarray(_.result.object_ids()).astype(str) for _ in self._matched()]
+        return np.concatenate(ids) if ids else np.array([], dtype=str)
+
+    def pages(self, page_size=sdb.PAGE_SIZE, progress=None, cancel=None):
+        done = 0
+        for source in self._matched():
+            def source_progress(fraction, done=done, n_spec=source.n_spec):
+                progress((done + fraction * n_spec) / self.n_spec)
+
+            yield from source.result.pages(page_size, progress and source_progress, cancel)
+            done += source.n_spec
+
+    def release(self):
+        """
+        Releases the databases, the spectra can't be read anymore.
+        """
+        for source in self.by_source.values():
+            if source.lease is not None:
+                source.lease.release()
+
+    def summary(self):
+        """
+        Returns one line per database with its count, time or error.
+        """
+        lines = []
+        for result in self.by_source.values():
+            if isinstance(result.error, TimeoutError):
+                status = "timed out"
+            elif result.error is not None:
+                status = f"failed: {result.error}"
+            else:
+                status = f"{result.n_spec} spectra"
+            lines.append(f"{result.name}: {status} ({result.elapsed:.1f} s)")
+        return "\n".join(lines)
+
+
+def _release_late(future):
+    # releases the database of a search whose result was not used
+    if future.exception() is None and future.result().lease is not None:
+        future.result().lease.release()
+
+
+def configured_databases(config):
+    """
+    Returns the databases listed in the configuration that exist, each once
+    (the "default" entry is usually another name of one of them).
+
+    Args:
+        config (dict): the configuration.
+
+    Returns:
+        dict: path of each database, by name.
+    """
+    databases, seen = {}, set()
+    entries = sorted(config.get("database", {}).items(), key=lambda _: _[0] == "default")
+    for name, path in entries:
+        if path and os.path.isfile(path) and os.path.realpath(path) not in seen:
+            seen.add(os.path.realpath(path))
+            databases[name] = path
+    return databases
+
+
+class FederatedSearch():
+    """
+    Runs a search on several databases at once, SpecDB and QUBRICS formatted.
+
+    Each database is searched by its own (daemon) thread, so the time taken
+    is about the one of the slowest database. A database that doesn't answer
+    within its timeout is reported as timed out; its search is cancelled, if
+    the search supports it, and left to finish in the background, without
+    keeping the program from exiting. Databases are leased from a
+    `DatabasePool`, which keeps them open between searches.
+
+    Attributes:
+        databases (dict): path of each database, by name.
+        timeouts (dict): timeout (s) of some databases, by name.
+        default_timeout (float): timeout (s) of the other databases.
+        pool (DatabasePool): where the databases are opened.
+    """
+
+    def __init__(self, databases, timeouts=None, default_timeout=60., pool=None):
+        self.databases = dict(databases)
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        self.pool = dbpool.pool if pool is None else pool
+        self._formats = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds a federated search over the databases of the configuration,
+        with the `federated_timeout` and `database_timeouts` options.
+        """
+        return cls(configured_databases(config), config.get("database_timeouts"),
+                   config.get("federated_timeout", 60.))
+
+    def _open(self, name):
+        # returns (lease, is_qubrics), the lease keeps the database open
+        #  while it is searched even if the pool evicts it
+        path = self.databases[name]
+        if name not in self._formats:
+            self._formats[name] = sdb.is_qubrics_file(path)
+        return self.pool.lease(path, self._formats[name]), self._formats[name]
+
+    def _run(self, name, search, cancel):
+        start = time.perf_counter()
+        result, n_spec, error, lease = None, 0, None, None
+        try:
+            with log.timed(f"federated.{name}"):
+                lease, is_qubrics = self._open(name)
+                result = search(lease.db, is_qubrics, cancel)
+                n_spec = result.count()
+        except Exception as e:
+            if not isinstance(e, sdb.SearchCancelled):
+                log.logger.error(f"Search of {name} failed: {e}")
+            if lease is not None:
+                lease.release()
+            result, n_spec, error, lease = None, 0, e, None
+        return SourceResult(name, self.databases[name], n_spec, result,
+                            error, time.perf_counter() - start, lease)
+
+    def _submit(self, name, search, cancel):
+        # runs `_run` on a daemon thread
+        future = Future()
+
+        def run():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self._run(name, search, cancel))
+                except BaseException as e:
+                    future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True, name=f"federated-{name}").start()
+        return future
+
+    def search(self, search, progress=None, cancel=None):
+        """
+        Runs a search on every database.
+
+        Args:
+            search (callable): called as `search(db, is_qubrics, cancel)` on
+                every database, returns the `sdb.SearchResult` of the
+                database (e.g. `sdb.find_spectra`).
+            progress (callable, optional): called with the fraction of the
+                databases done.
+            cancel (threading.Event, optional): set it to cancel the search.
+
+        Raises:
+            InvalidInput: If every database rejected the search as invalid.
+            SearchCancelled: If `cancel` is set.
+
+        Returns:
+            FederatedResult: the merged results, to release once read.
+        """
+        start = time.perf_counter()
+        names = list(self.databases)
+        cancels = {name: threading.Event() for name in names}
+        futures = {name: self._submit(name, search, cancels[name]) for name in names}
+
+        # wait for each database until its deadline, earliest deadline first
+        results = {}
+        try:
+            for name in sorted(names, key=lambda _: self.timeouts.get(_, self.default_timeout)):
+                deadline = start + self.timeouts.get(name, self.default_timeout)
+                while name not in results:
+                    if cancel is not None and cancel.is_set():
+                        raise sdb.SearchCancelled("Search cancelled.")
+                    try:
+                        # wake up regularly to notice a cancellation
+                        results[name] = futures[name].result(
+                            timeout=max(0., min(0.5, deadline - time.perf_counter())))
+                    except TimeoutError:
+                        if time.perf_counter() >= deadline:
+                            cancels[name].set()
+                            # its database is released once it finishes
+                            futures[name].add_done_callback(_release_late)
+                            results[name] = SourceResult(
+                                name, self.databases[name], 0, None,
+                                TimeoutError(f"{name} timed out"),
+                                time.perf_counter() - start, None)
+                            log.logger.error(f"Search of {name} timed out.")
+                if progress is not None:
+                    progress(len(results) / len(names))
+        except BaseException:
+            for name in names:
+                cancels[name].set()
+                if name not in results:
+                    futures[name].add_done_callback(_release_late)
+            FederatedResult(list(results.values())).release()
+            raise
+        result = FederatedResult([results[name] for name in names])
+        errors = [results[name].error for name in names]
+        if errors and all(isinstance(_, utils.InvalidInput) for _ in errors):
+            result.release()
+            raise errors[0]
+        return result
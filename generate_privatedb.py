@@ -2,64 +2,263 @@
 from specdb.build import utils as spbu
 from specdb.build import privatedb as pbuild
 from linetools import utils as ltu
-from astropy.table import Table
+from astropy.table import Table, vstack
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import argparse
+import hashlib
 import glob
+import json
 import h5py
+import os
 import warnings
 warnings.filterwarnings('ignore')
 
-tree = "/home/francio/private_db/spectra/"
-branches = glob.glob(tree + '*')
-
 id_key = 'QUBRICS_ID'
-maindb, tkeys = spbu.start_maindb(id_key)
-
-mflux_files, meta_file = pbuild.grab_files(branches[0])
-meta_dict = ltu.loadjson(meta_file[0])
+group_name = 'QUBRICS'
 
-# Read redshift, and deal with all shenaningans
-ztbl = Table.read("/media/data/Data/Catalogues/QSO_SDSS_Spectra/DR18_DB.fits")
-# now some magic to make sure the format is consistent with SpecDB
+# inputs the checkpoints of a work directory were built from
+MANIFEST = "manifest.json"
+# every kind of checkpoint, removed when the inputs change
+CHECKPOINTS = ("ztbl.fits", "meta_*.fits", "spec_*.hdf5", "done.json")
+# rows of the spectra copied at a time when merging the pieces
+MERGE_BLOCK = 1000
 
 
 def get_spec_file(plate, mjd, fiber):
     """
-    Generates filenames
+    Generates filenames, works on arrays too
+    """
+    plate = np.char.zfill(np.asarray(plate).astype(str), 4)
+    mjd = np.asarray(mjd).astype(str)
+    fiber = np.char.zfill(np.asarray(fiber).astype(str), 4)
+
+    name = np.char.add("spec-", plate)
+    for part in ("-", mjd, "-", fiber, ".fits"):
+        name = np.char.add(name, part)
+    return name
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def checkpoint_inputs(ztbl_file, mflux_files, meta_dict, chunk_size):
+    """
+    Describes what the checkpoints depend on: the redshift table (path and
+    stamp), the list of spectra, the meta parsing options and the chunks.
+    """
+    stat = os.stat(ztbl_file)
+    return {"ztbl": os.path.abspath(ztbl_file),
+            "ztbl_stamp": [stat.st_mtime_ns, stat.st_size],
+            "n_files": len(mflux_files),
+            "files": _digest(sorted(mflux_files)),
+            "meta_dict": _digest(meta_dict),
+            "chunk_size": chunk_size}
+
+
+def check_checkpoints(workdir, inputs):
+    """
+    Keeps the checkpoints of a work directory only if they were built from
+    the same inputs, otherwise removes them and records the new inputs.
+    """
+    manifest = os.path.join(workdir, MANIFEST)
+    if os.path.isfile(manifest):
+        with open(manifest) as f:
+            if json.load(f) == inputs:
+                return
+        print(f"{workdir}: the inputs changed since the checkpoints were written, "
+              "starting from scratch")
+    for pattern in CHECKPOINTS:
+        for path in glob.glob(os.path.join(workdir, pattern)):
+            os.remove(path)
+    with open(manifest + ".tmp", "w") as f:
+        json.dump(inputs, f)
+    os.replace(manifest + ".tmp", manifest)
+
+
+def _atomic_write(tbl, path):
+    # a crash while writing must not leave a checkpoint that looks complete
+    tmp_path = path + ".tmp.fits"
+    tbl.write(tmp_path, overwrite=True)
+    os.replace(tmp_path, path)
+
+
+def prepare_ztbl(ztbl_file, out_file):
+    """
+    Reads the redshift table, and deals with all shenanigans to make sure
+    the format is consistent with SpecDB
     """
-    return f"spec-{plate:04}-{mjd}-{fiber:04}.fits"
+    ztbl = Table.read(ztbl_file)
+
+    # Rename cols
+    ztbl.rename_columns(["RAd", "DECd", "z_spec"], ["RA", "DEC", "ZEM"])
+
+    # Add extra, required
+    ztbl["ZEM_SOURCE"] = "SDSS"
+    ztbl["SPEC_FILE"] = get_spec_file(
+        ztbl['PLATE'][:, 0], ztbl['MJD'][:, 0], ztbl['FIBERID'][:, 0])
+
+    # Select columns you need
+    ztbl = ztbl['RA', 'DEC', 'ZEM', 'ZEM_SOURCE', 'SPEC_FILE', 'qid']
+
+    # and flatten the one you need to flatten
+    for colname in ['RA', 'DEC', 'ZEM', 'qid']:
+        ztbl[colname] = np.ravel(ztbl[colname])
+
+    _atomic_write(ztbl, out_file)
+
+
+def _meta_chunk(files, ztbl_file, meta_dict, out_file):
+    # runs in a worker: header parsing of one chunk of spectra
+    ztbl = Table.read(ztbl_file)
+    meta = pbuild.mk_meta(files, ztbl, fname=False,
+                          mdict=meta_dict['meta_dict'], parse_head=meta_dict['parse_head'])
+    _atomic_write(meta, out_file)
+    return out_file
+
+
+def build_meta(pool, mflux_files, meta_dict, workdir, chunk_size, mtbl_file=None):
+    """
+    Creates meta, parsing the headers of the spectra in a pool of workers.
+    Every chunk is checkpointed, so chunks already done are skipped on resume
+    """
+    ztbl_file = os.path.join(workdir, "ztbl.fits")
+    chunks = [sorted(mflux_files)[i:i + chunk_size]
+              for i in range(0, len(mflux_files), chunk_size)]
+    chunk_files = [os.path.join(workdir, f"meta_{n:05}.fits") for n in range(len(chunks))]
+
+    todo = [n for n, out_file in enumerate(chunk_files) if not os.path.isfile(out_file)]
+    print(f"meta: {len(chunks) - len(todo)} of {len(chunks)} chunks already done")
+    for out_file in pool.map(_meta_chunk, [chunks[n] for n in todo],
+                             [ztbl_file] * len(todo), [meta_dict] * len(todo),
+                             [chunk_files[n] for n in todo]):
+        print(f"meta: wrote {out_file}")
+
+    meta = vstack([Table.read(_) for _ in chunk_files], metadata_conflicts='silent')
+    if mtbl_file is not None:
+        meta.write(mtbl_file, overwrite=True)
+    return meta
+
+
+def _spec_chunk(meta, max_npix, out_file):
+    # runs in a worker: reads the spectra of one chunk into its own file
+    tmp_path = out_file + ".tmp"
+    with h5py.File(tmp_path, 'w') as hdf:
+        pbuild.ingest_spectra(hdf, group_name, meta, max_npix=max_npix)
+    os.replace(tmp_path, out_file)
+    return out_file
+
+
+def ingest_spectra(pool, meta, max_npix, workdir, chunk_size):
+    """
+    Reads the spectra in a pool of workers, each chunk of meta into its own
+    HDF5 piece. Pieces are checkpointed, so chunks already done are skipped
+    on resume
+
+    Returns the paths of the pieces, in the order of meta
+    """
+    starts = range(0, len(meta), chunk_size)
+    piece_files = [os.path.join(workdir, f"spec_{n:05}.hdf5") for n in range(len(starts))]
+    todo = [n for n, out_file in enumerate(piece_files) if not os.path.isfile(out_file)]
+    print(f"spectra: {len(starts) - len(todo)} of {len(starts)} chunks already done")
+    for out_file in pool.map(_spec_chunk, [meta[starts[n]:starts[n] + chunk_size] for n in todo],
+                             [max_npix] * len(todo), [piece_files[n] for n in todo]):
+        print(f"spectra: wrote {out_file}")
+    return piece_files
+
+
+def merge_spectra(hdf, piece_files):
+    """
+    Copies the pieces written by `ingest_spectra` into the database: their
+    spectra one after the other, in blocks, and their meta stacked
+    """
+    pieces = [h5py.File(_, 'r') for _ in piece_files]
+    try:
+        first = pieces[0][group_name]
+        src = first['spec']
+        group = hdf.create_group(group_name)
+        group.attrs.update(first.attrs)
+        spec = group.create_dataset(
+            'spec', shape=(sum(len(_[group_name]['spec']) for _ in pieces),), dtype=src.dtype,
+            chunks=src.chunks or True, maxshape=(None,),
+            compression=src.compression, compression_opts=src.compression_opts)
+        start, metas = 0, []
+        for piece in pieces:
+            src = piece[group_name]['spec']
+            for i in range(0, len(src), MERGE_BLOCK):
+                block = src[i:i + MERGE_BLOCK]
+                spec[start + i:start + i + len(block)] = block
+            start += len(src)
+            metas.append(Table(piece[group_name]['meta'][:]))
+        meta = vstack(metas, metadata_conflicts='silent')
+        group.create_dataset('meta', data=meta.as_array())
+    finally:
+        for piece in pieces:
+            piece.close()
+    return meta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Builds the QUBRICS database, resuming from the last checkpoint if interrupted.")
+    parser.add_argument("--tree", default="/home/francio/private_db/spectra/")
+    parser.add_argument("--ztbl", default="/media/data/Data/Catalogues/QSO_SDSS_Spectra/DR18_DB.fits")
+    parser.add_argument("--mtbl-file", default="/home/francio/private_db/SDSS_meta.fits")
+    parser.add_argument("--output", default="QUBRICS.hdf5")
+    parser.add_argument("--workdir", default="QUBRICS_build",
+                        help="Where checkpoints are kept; remove it to start from scratch.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=2000,
+                        help="Spectra per checkpointed chunk of meta and of spectra.")
+    parser.add_argument("--version", default="v01")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.workdir, exist_ok=True)
+    branches = glob.glob(args.tree + '*')
+
+    maindb, tkeys = spbu.start_maindb(id_key)
 
+    mflux_files, meta_file = pbuild.grab_files(branches[0])
+    meta_dict = ltu.loadjson(meta_file[0])
 
-# Rename cols
-ztbl.rename_columns(["RAd", "DECd", "z_spec"], ["RA", "DEC", "ZEM"])
+    # checkpoints built from other inputs are thrown away
+    check_checkpoints(args.workdir, checkpoint_inputs(
+        args.ztbl, mflux_files, meta_dict, args.chunk_size))
 
-# Add extra, required
-ztbl["ZEM_SOURCE"] = "SDSS"
-ztbl["SPEC_FILE"] = [get_spec_file(
-    ztbl['PLATE'][i][0], ztbl['MJD'][i][0], ztbl['FIBERID'][i][0]) for i in range(len(ztbl['MJD']))]
+    # Read redshift
+    ztbl_file = os.path.join(args.workdir, "ztbl.fits")
+    if not os.path.isfile(ztbl_file):
+        prepare_ztbl(args.ztbl, ztbl_file)
 
-# Select columns you need
-ztbl = ztbl['RA', 'DEC', 'ZEM', 'ZEM_SOURCE', 'SPEC_FILE', 'qid']
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        # create meta
+        meta = build_meta(pool, mflux_files, meta_dict, args.workdir,
+                          args.chunk_size, args.mtbl_file)
 
-# and flatten the one you need to flatten
-for colname in ['RA', 'DEC', 'ZEM', 'qid']:
-    ztbl[colname] = ztbl[colname].flatten()
+        # add groups and IDS
+        gdict = {}
+        flag_g = spbu.add_to_group_dict(group_name, gdict)
+        maindb = pbuild.add_ids(maindb, meta, flag_g, tkeys,
+                                id_key, first=(flag_g == 1))
 
-# create meta
-meta = pbuild.mk_meta(mflux_files, ztbl, fname=False,
-                      mdict=meta_dict['meta_dict'], parse_head=meta_dict['parse_head'],
-                      mtbl_file="/home/francio/private_db/SDSS_meta.fits")
+        # read the spectra, the slow part
+        piece_files = ingest_spectra(pool, meta, meta_dict['maxpix'],
+                                     args.workdir, args.chunk_size)
 
-# add groups and IDS
-gdict = {}
-flag_g = spbu.add_to_group_dict('QUBRICS', gdict)
-maindb = pbuild.add_ids(maindb, meta, flag_g, tkeys,
-                        id_key, first=(flag_g == 1))
+    # create file, under a temporary name until it is complete: only the
+    #  merge of the pieces is redone after a crash here
+    partial = args.output + ".partial"
+    hdf = h5py.File(partial, 'w')
+    meta = merge_spectra(hdf, piece_files)
 
+    pbuild.write_hdf(hdf, group_name, maindb, [str('SDSS')], gdict, args.version)
+    hdf.close()
+    os.replace(partial, args.output)
 
-# create file
-hdf = h5py.File('QUBRICS.hdf5', 'w')
-pbuild.ingest_spectra(hdf, 'QUBRICS', meta,
-                      max_npix=meta_dict['maxpix'])
+    with open(os.path.join(args.workdir, "done.json"), "w") as f:
+        json.dump({"output": args.output, "n_spectra": len(meta)}, f)
 
 
-pbuild.write_hdf(hdf, 'QUBRICS', maindb, [str('SDSS')], gdict, 'v01')
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,27 @@
+import sys
+import lazy
+
+# time the imports below too
+if "--profile-startup" in sys.argv:
+    lazy.profiler.start()
+
 from config import config, load_config
 
 import PySimpleGUI as sg
 import utils
-import sys
 import os
+import argparse
+import threading
 import log
 import sdb
+import plot
+import federated
+import dbpool
 
-# check if SpecDB is installed by trying an import
-try:
-    from specdb.specdb import SpecDB
+# check if SpecDB is installed, it is only imported when a SpecDB database is opened
+if lazy.is_installed("specdb"):
     config["specdb_installed"] = True
-except ModuleNotFoundError:
+else:
     log.logger.warning(
         "SpecDB not found! You will only be able to search QUBRICS' formatted databases.")
     config["specdb_installed"] = False
@@ -39,7 +49,16 @@ def make_search_window():
             sg.Text("DEC (deg)"), sg.InputText(size=(20, 1), key='-DEC_DEG-')],
         [sg.Text("qid     "),  sg.InputText(size=(20, 1), key='-QID-'),
             sg.Text("Matching r. ('')"), sg.InputText(size=(5, 1), key='-MATCH_R-', default_text="1")],
-        [sg.B("Search"), sg.B("Open (mpl)"), sg.B("Open (Astrocook)")]
+        [sg.Text("λ min (Å)"), sg.InputText(size=(10, 1), key='-WAVE_MIN-'),
+            sg.Text("λ max (Å)"), sg.InputText(size=(10, 1), key='-WAVE_MAX-'),
+            sg.Checkbox("Rest frame", key='-REST_FRAME-')],
+        [sg.Checkbox("Search all the configured databases", key='-ALL_DBS-')],
+        [sg.Text("Query"), sg.InputText(size=(50, 1), key='-QUERY-',
+                                        tooltip="e.g. ZEM=2.5:3.5; ZEM_SOURCE=SDSS,BOSS")],
+        [sg.B("Search"), sg.B("Cancel", key='-CANCEL_SEARCH-', disabled=True),
+            sg.B("Batch search"), sg.B("Open (mpl)"), sg.B("Open (Astrocook)"), sg.B("Export")],
+        [sg.ProgressBar(100, orientation='h', size=(30, 10), key='-PROGRESS-'),
+            sg.Text("", size=(20, 1), key='-STATUS-')]
     ]
     return sg.Window('Search in DB', layout, finalize=True)
 
@@ -48,24 +67,142 @@ def load_db(active_db=None, is_qubrics=False):
     if not config["specdb_installed"] and not is_qubrics:
         return False, None
 
-    if is_qubrics:
-        config["active_db"] = active_db
-        return True, None
-    else:
-        db = SpecDB(db_file=config["active_db"])
-        config["active_db"] = active_db
-        return True, db
+    config["active_db"] = active_db
+    return True, dbpool.pool.get(active_db, is_qubrics)
+
+
+def run_search(window, search_id, values, cancel, db_file, is_qubrics, fed=None):
+    # runs on a worker thread, results are sent back as window events with
+    #  what keeps their databases open until they are replaced
+    def progress(fraction):
+        window.write_event_value('-SEARCH_PROGRESS-', (search_id, fraction))
+
+    lease = None
+    try:
+        if fed is not None:
+            # the merged results hold the leases of their databases, and
+            #  are read a page at a time like those of a single one
+            result = fed.search(lambda db, is_qubrics, cancel: sdb.find_spectra(
+                values, db, is_qubrics=is_qubrics, config=config),
+                progress=progress, cancel=cancel)
+            lease = result
+        else:
+            # the pool reopens the database if it was evicted or changed on disk
+            lease = dbpool.pool.lease(db_file, is_qubrics)
+            # only the matches are found here, spectra are read when opened or exported
+            result = sdb.find_spectra(values, lease.db, is_qubrics=is_qubrics, config=config)
+            result.count()
+    except Exception as e:
+        if lease is not None:
+            lease.release()
+        result, lease = e, None
+    window.write_event_value('-SEARCH_DONE-', (search_id, result, lease))
+
+
+def run_read(window, task_id, action, results, results_id, cancel, out_file=None):
+    # reads the spectra of the results shown on a worker thread, like
+    #  run_search: Astrocook is opened and the plot made on the main thread
+    last = [-1]
+
+    def progress(fraction):
+        if int(100 * fraction) != last[0]:
+            last[0] = int(100 * fraction)
+            window.write_event_value('-SEARCH_PROGRESS-', (task_id, fraction))
+
+    try:
+        spectra = results.iter_spectra(progress=progress, cancel=cancel)
+        if action == "Open (Astrocook)":
+            result = utils.write_export([spectra], key=results_id)
+        elif action == "Export":
+            try:
+                utils.write_consolidated(spectra, out_file)
+            except BaseException:
+                # don't leave a partial file behind
+                if os.path.isfile(out_file):
+                    os.remove(out_file)
+                raise
+            result = out_file
+        else:
+            result = list(spectra)
+    except Exception as e:
+        result = e
+    window.write_event_value('-READ_DONE-', (task_id, action, result))
 
 
-def main():
-    spectra = [None]
+def set_searching(window, searching, status=""):
+    window['-CANCEL_SEARCH-'].update(disabled=not searching)
+    window['-STATUS-'].update(status)
+    if not searching:
+        window['-PROGRESS-'].update(0)
+
+
+def batch_search(values):
+    target_file = sg.popup_get_file(
+        "Select a target list (CSV or FITS).", title="Batch search")
+    if not target_file:
+        return
+    try:
+        RA, DEC, tol = utils.parse_targets(target_file, values['-MATCH_R-'])
+        with dbpool.pool.lease(config["active_db"], config["qubrics_db"]) as db:
+            matches = sdb.batch_search(
+                RA, DEC, tol, db, is_qubrics=config["qubrics_db"], config=config)
+    except utils.InvalidInput as e:
+        sg.popup(str(e), title="Error")
+        log.logger.error(str(e))
+        return
+
+    n_targets = len(set(matches["target"]))
+    out_file = sg.popup_get_file(
+        f"Matched {n_targets} of {len(RA)} targets ({len(matches)} matches).\n"
+        "Save the match table to:", title="Info", save_as=True,
+        default_extension=".fits", file_types=(("FITS", "*.fits"), ("CSV", "*.csv")))
+    if out_file:
+        matches.write(out_file, overwrite=True)
+
+
+def prewarm_dbs():
+    # opens the databases of the configuration in the background, the
+    #  default one last so that it stays open
+    databases = federated.configured_databases(config)
+    default = config["database"].get("default")
+    paths = sorted(databases.values(), key=lambda _: _ == default)
+    entries = []
+    for path in paths:
+        is_qubrics = sdb.is_qubrics_file(path)
+        if is_qubrics or config["specdb_installed"]:
+            entries.append((path, is_qubrics))
+    dbpool.pool.prewarm(entries)
+
+
+def main(profile_startup=False):
+    results = None
+    # only the results of the latest search are applied, results_id
+    #  identifies the ones being shown (to reuse their Astrocook export)
+    search_id, results_id, cancel = 0, None, None
+    # the pool doesn't close the databases of the results shown, their
+    #  spectra are read later: a lease, or the results of a federated search
+    results_lease = None
+    # searches all the configured databases, created on first use
+    fed = None
+    sdb.spec_cache.resize(int(config.get("spec_cache_mb", 0) * 2**20))
+    # dumped with the timings, see --stats
+    log.stats.add_counters("spectrum cache", sdb.spec_cache.stats)
+    dbpool.pool.max_open = config.get("max_open_dbs", dbpool.pool.max_open)
+    if config.get("prewarm_dbs", False):
+        prewarm_dbs()
 
     # Create the window
     file_window, search_window = make_db_select_window(), None
+    if profile_startup:
+        lazy.profiler.report(lazy.profiler.stop())
 
     # Event loop
     while True:
-        window, event, values = sg.read_all_windows()
+        window, event, values = sg.read_all_windows(timeout=1000)
+
+        if event == sg.TIMEOUT_EVENT:
+            utils.reap_ac()
+            continue
 
         if window == file_window and event in (sg.WINDOW_CLOSED, "Cancel"):
             break
@@ -74,7 +211,19 @@ def main():
             if os.path.isfile(values["-FILE-"]) and values["-FILE-"].endswith(".hdf5"):
                 config["active_db"] = values["-FILE-"]
                 config["qubrics_db"] = values["is_qubrics_db"]
-                ok, db = load_db(config["active_db"], config["qubrics_db"])
+                # the search or read running is cancelled, as with Cancel
+                if cancel is not None:
+                    cancel.set()
+                    search_id, cancel = search_id + 1, None
+                    if search_window is not None:
+                        set_searching(search_window, False, "Cancelled.")
+                try:
+                    ok, _ = load_db(config["active_db"], config["qubrics_db"])
+                except Exception as e:
+                    sg.popup_error(f"Could not open {config['active_db']}: {e}",
+                                   title="Error")
+                    log.logger.error(str(e), exc_info=e)
+                    continue
                 if not search_window:
                     search_window = make_search_window() if ok else sg.popup(
                         log.wrong_db_format, title="Error")
@@ -88,37 +237,118 @@ def main():
 
         if window == search_window:
             if event in (sg.WIN_CLOSED, 'Exit'):
+                if cancel is not None:
+                    cancel.set()
+                search_id, cancel = search_id + 1, None
                 search_window.close()
                 search_window = None
             elif event == "Search":
-                try:
-                    spectra, n_spec = sdb.search_spectra(
-                        values, db, is_qubrics=config["qubrics_db"], config=config)
-                    sg.popup(f'Found {n_spec} spectra!', title="Info")
-                except utils.InvalidInput as e:
-                    sg.popup(str(e), title="Error")
-                    log.logger.error(str(e))
-            elif event == "Open (Astrocook)":
-                if spectra[0] is None:
-                    sg.popup("Nothing to open.", title="Warning")
+                if cancel is not None:
+                    cancel.set()
+                search_id, cancel = search_id + 1, threading.Event()
+                if values['-ALL_DBS-'] and fed is None:
+                    fed = federated.FederatedSearch.from_config(config)
+                threading.Thread(target=run_search, daemon=True,
+                                 args=(search_window, search_id, dict(values), cancel,
+                                       config["active_db"], config["qubrics_db"],
+                                       fed if values['-ALL_DBS-'] else None)).start()
+                set_searching(search_window, True, "Searching...")
+            elif event == '-CANCEL_SEARCH-':
+                if cancel is not None:
+                    cancel.set()
+                search_id, cancel = search_id + 1, None
+                set_searching(search_window, False, "Cancelled.")
+            elif event == '-SEARCH_PROGRESS-':
+                _id, fraction = values[event]
+                if _id == search_id:
+                    search_window['-PROGRESS-'].update(int(100 * fraction))
+            elif event == '-SEARCH_DONE-':
+                _id, result, lease = values[event]
+                if _id != search_id:
+                    if lease is not None:
+                        lease.release()
+                    continue
+                cancel = None
+                set_searching(search_window, False)
+                if isinstance(result, utils.InvalidInput):
+                    sg.popup(str(result), title="Error")
+                    log.logger.error(str(result))
+                elif isinstance(result, Exception):
+                    sg.popup(f"Search failed: {result}", title="Error")
+                    log.logger.error(str(result), exc_info=result)
                 else:
-                    utils.write_and_open(spectra)
-            elif event == "Open (mpl)":
-                print("TODO! Use astrocook if you can, it's much better anyway!")
-                pass
+                    results, results_id = result, search_id
+                    if results_lease is not None:
+                        results_lease.release()
+                    results_lease = lease
+                    utils.release_exports(keep=results_id)
+                    summary = ("\n\n" + result.summary()
+                               if isinstance(result, federated.FederatedResult) else "")
+                    sg.popup(f'Found {result.count()} spectra!{summary}', title="Info")
+            elif event == "Batch search":
+                batch_search(values)
+            elif event in ("Open (Astrocook)", "Export", "Open (mpl)"):
+                out_file = None
+                if results is None or results.count() == 0:
+                    sg.popup(f"Nothing to {'export' if event == 'Export' else 'open'}.",
+                             title="Warning")
+                    continue
+                if event == "Open (mpl)" and not lazy.is_installed("matplotlib"):
+                    sg.popup("matplotlib is not installed.", title="Error")
+                    continue
+                if event == "Export":
+                    out_file = sg.popup_get_file(
+                        "Export the spectra to a single file:", title="Export", save_as=True,
+                        default_extension=".fits", file_types=(("FITS", "*.fits"), ("HDF5", "*.hdf5")))
+                    if not out_file:
+                        continue
+                # reading the spectra replaces the running search, if any
+                if cancel is not None:
+                    cancel.set()
+                search_id, cancel = search_id + 1, threading.Event()
+                threading.Thread(target=run_read, daemon=True,
+                                 args=(search_window, search_id, event, results, results_id,
+                                       cancel, out_file)).start()
+                set_searching(search_window, True, "Reading spectra...")
+            elif event == '-READ_DONE-':
+                _id, action, result = values[event]
+                if _id != search_id:
+                    continue
+                cancel = None
+                set_searching(search_window, False)
+                if isinstance(result, Exception):
+                    sg.popup(f"Reading the spectra failed: {result}", title="Error")
+                    log.logger.error(str(result), exc_info=result)
+                elif action == "Open (Astrocook)":
+                    utils.reap_ac()
+                    utils.open_ac(result)
+                elif action == "Open (mpl)":
+                    plot.plot_spectra(result, title=f"Search {results_id}")
 
     # Close the window
+    if cancel is not None:
+        cancel.set()
     file_window.close()
     if search_window is not None:
         search_window.close()
-    # close open database
-    try:
-        # SpecDB deals with closin the DB on his own apparently
-        db.close()
-    except (AttributeError, UnboundLocalError):
-        log.logger.warning("Nothing to close.")
+    # close open databases, the leased ones (maybe still read) are closed at exit
+    dbpool.pool.close_all()
+    plot.close_all()
+    utils.shutdown_ac()
 
 
 if __name__ == '__main__':
-    load_config(sys.argv[1] if len(sys.argv) > 1 else None)
-    main()
+    parser = argparse.ArgumentParser(description="SpecDB GUI")
+    parser.add_argument("config", nargs="?", default=None,
+                        help="Configuration file, defaults to config.yaml.")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Report the time spent importing modules before the first window.")
+    parser.add_argument("--stats", nargs="?", const="", default=None, metavar="FILE",
+                        help="Print the timings of searches, reads and writes at exit "
+                             "(to a JSON file if given).")
+    args = parser.parse_args()
+    load_config(args.config)
+    log.dump_on_signal()
+    if args.stats is not None:
+        log.dump_at_exit(args.stats or None)
+    main(profile_startup=args.profile_startup)
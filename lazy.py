@@ -0,0 +1,126 @@
+import sys
+import time
+import builtins
+import importlib
+import importlib.util
+
+
+class LazyModule():
+    """
+    A placeholder for a module, imported the first time one of its attributes
+    is accessed.
+
+    Attributes:
+        name (str): the full name of the module.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self.name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self.name}' ({state})>"
+
+
+def lazy_import(name):
+    """
+    Returns a module that is only imported when first used.
+
+    Args:
+        name (str): the full name of the module, e.g. "astropy.io.fits".
+
+    Returns:
+        module or LazyModule: the module, if already imported, or a placeholder.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def is_installed(name):
+    """
+    Checks if a top-level package can be imported, without importing it.
+
+    Args:
+        name (str): the package name.
+
+    Returns:
+        bool: True if the package is available.
+    """
+    return importlib.util.find_spec(name) is not None
+
+
+class ImportProfiler():
+    """
+    Measures the time spent importing modules, by wrapping `__import__`.
+
+    Attributes:
+        start_time (float): when profiling started (`time.perf_counter`).
+        times (dict): cumulative import time (s) of every module imported
+            while profiling, including the modules it imports.
+        top_level (list): the modules imported directly by the profiled code.
+    """
+
+    def __init__(self):
+        self.start_time = None
+        self.times = {}
+        self.top_level = []
+        self._depth = 0
+        self._import = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def stop(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+        return time.perf_counter() - self.start_time
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level != 0 or name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            self._depth -= 1
+            self.times[name] = time.perf_counter() - start
+            if self._depth == 0:
+                self.top_level.append(name)
+
+    def report(self, elapsed, label="first window", n_slowest=15, file=sys.stderr):
+        """
+        Prints the import times.
+
+        Args:
+            elapsed (float): total time to report (s), e.g. as returned by `stop`.
+            label (str, optional): what `elapsed` measures.
+            n_slowest (int, optional): how many of the slowest imports to list.
+            file (file, optional): where to print. Defaults to the standard error.
+
+        Returns:
+            None.
+        """
+        print(f"Time to {label}: {elapsed * 1e3:.0f} ms", file=file)
+        print("Direct imports (cumulative ms):", file=file)
+        for name in self.top_level:
+            print(f"  {self.times[name] * 1e3:9.1f}  {name}", file=file)
+        print(f"Slowest {n_slowest} imports (cumulative ms):", file=file)
+        slowest = sorted(self.times.items(), key=lambda _: -_[1])[:n_slowest]
+        for name, elapsed in slowest:
+            print(f"  {elapsed * 1e3:9.1f}  {name}", file=file)
+
+
+# started by the entry points when asked to (e.g. `gui.py --profile-startup`)
+profiler = ImportProfiler()
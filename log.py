@@ -1,21 +1,214 @@
+import sys
+import json
+import time
+import queue
+import atexit
+import signal
 import logging
+import threading
+import functools
+import contextlib
+import logging.handlers
 
 logger = logging.getLogger()
 logger.setLevel(logging.ERROR)
 
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line.
+
+    The fields passed as `extra={"metrics": {...}}` are added to the object.
+    """
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname,
+                 "logger": record.name, "message": record.getMessage()}
+        entry.update(getattr(record, "metrics", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+formatter = JsonFormatter()
+
 # Output logs to console
 # ch = logging.StreamHandler()
 # ch.setLevel(logging.ERROR)
-formatter = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 # ch.setFormatter(formatter)
 # logger.addHandler(ch)
 
-# Output logs to file
-fh = logging.FileHandler('mylog.log')
-fh.setLevel(logging.ERROR)
+# Output logs to file. Records are queued and written by a background thread,
+# so logging never blocks the caller on disk
+fh = logging.FileHandler('mylog.log', delay=True)
 fh.setFormatter(formatter)
-logger.addHandler(fh)
+log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+listener = logging.handlers.QueueListener(log_queue, fh)
+listener.start()
+atexit.register(listener.stop)
+
+
+class Stats():
+    """
+    Aggregated timings of the instrumented operations.
+
+    Every operation has a count, the total and maximum duration (s) and the
+    total bytes and rows it reported. Counters kept elsewhere (e.g. the hits
+    of a cache) can be added with `add_counters`, they are read when dumped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._counters = {}
+
+    def add(self, name, elapsed, nbytes=0, rows=0):
+        with self._lock:
+            entry = self._stats.setdefault(
+                name, {"count": 0, "total": 0., "max": 0., "bytes": 0, "rows": 0})
+            entry["count"] += 1
+            entry["total"] += elapsed
+            entry["max"] = max(entry["max"], elapsed)
+            entry["bytes"] += nbytes
+            entry["rows"] += rows
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._stats.items()}
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+    def add_counters(self, name, counters):
+        """
+        Adds counters to the statistics.
+
+        Args:
+            name (str): name of the counters.
+            counters (callable): returns the counters, as a dict.
+
+        Returns:
+            None.
+        """
+        with self._lock:
+            self._counters[name] = counters
+
+    def counters(self):
+        with self._lock:
+            counters = dict(self._counters)
+        return {name: dict(get()) for name, get in counters.items()}
+
+    def dump(self, file=sys.stderr):
+        """
+        Writes the statistics as a table, slowest operations first.
+
+        Args:
+            file (file, optional): where to write. Defaults to the standard error.
+
+        Returns:
+            None.
+        """
+        stats = sorted(self.snapshot().items(), key=lambda _: -_[1]["total"])
+        print(f"{'operation':<28} {'count':>7} {'total (s)':>10} {'mean (ms)':>10} "
+              f"{'max (ms)':>10} {'MB':>9} {'rows':>9}", file=file)
+        for name, entry in stats:
+            print(f"{name:<28} {entry['count']:7d} {entry['total']:10.3f} "
+                  f"{entry['total'] / entry['count'] * 1e3:10.2f} {entry['max'] * 1e3:10.2f} "
+                  f"{entry['bytes'] / 1e6:9.1f} {entry['rows']:9d}", file=file)
+        for name, counters in self.counters().items():
+            print(f"{name}: " + ", ".join(f"{key} {value}" for key, value in counters.items()),
+                  file=file)
+
+    def save(self, path):
+        """
+        Writes the statistics to a JSON file, the counters under "counters".
+
+        Args:
+            path (str): the output file.
+
+        Returns:
+            None.
+        """
+        with open(path, "w") as f:
+            json.dump(dict(self.snapshot(), counters=self.counters()), f, indent=1)
+
+
+stats = Stats()
+
+
+@contextlib.contextmanager
+def timed(name):
+    """
+    Times a block of code and adds it to `stats`.
+
+    The block can report what it did by setting "bytes" and "rows" in the
+    dictionary returned. With the DEBUG level each timing is also logged.
+
+    Args:
+        name (str): name of the operation.
+
+    Yields:
+        dict: the metrics of this run.
+    """
+    metrics = {}
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        elapsed = time.perf_counter() - start
+        stats.add(name, elapsed, metrics.get("bytes", 0), metrics.get("rows", 0))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(name, extra={"metrics": dict(metrics, operation=name, elapsed=elapsed)})
+
+
+def traced(name, rows=None):
+    """
+    Decorator timing every call of a function with `timed`.
+
+    Args:
+        name (str): name of the operation.
+        rows (callable, optional): gets the number of rows from the returned value.
+
+    Returns:
+        callable: the decorator.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(name) as metrics:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    metrics["rows"] = rows(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def dump_on_signal(signum=getattr(signal, "SIGUSR1", None)):
+    """
+    Dumps `stats` to the standard error whenever the process gets a signal
+    (SIGUSR1 by default), e.g. `kill -USR1 <pid>` during a slow query.
+    Must be called from the main thread; does nothing where the signal
+    doesn't exist.
+
+    Returns:
+        None.
+    """
+    if signum is not None:
+        signal.signal(signum, lambda *args: stats.dump())
+
+
+def dump_at_exit(path=None):
+    """
+    Dumps `stats` when the program exits: to a JSON file if `path` is given,
+    as a table on the standard error otherwise.
+
+    Returns:
+        None.
+    """
+    atexit.register(lambda: stats.save(path) if path is not None else stats.dump())
 
 
 wrong_db_format = """
@@ -0,0 +1,152 @@
+import numpy as np
+
+import utils
+from lazy import lazy_import
+
+plt = lazy_import("matplotlib.pyplot")
+
+# spectra with fewer visible pixels than this are drawn as they are
+MIN_DECIMATE = 4096
+
+# plots still open, so that they aren't garbage collected
+open_plots = []
+
+
+def minmax_decimate(x, y, xmin, xmax, n_bins):
+    """
+    Reduces the points of a curve in a range, keeping its envelope.
+
+    The points with `xmin <= x <= xmax` (plus one on each side, so the line
+    reaches the edges) are split into `n_bins` runs of consecutive points,
+    and only the minimum and the maximum of each run are kept, in their
+    order. With one bin per screen pixel the drawing looks the same as the
+    full curve.
+
+    Args:
+        x (ndarray): the abscissae, sorted.
+        y (ndarray): the ordinates.
+        xmin (float): lower end of the range.
+        xmax (float): upper end of the range.
+        n_bins (int): number of bins, e.g. the width of the axes in pixels.
+
+    Returns:
+        tuple: the decimated x and y.
+    """
+    start = max(np.searchsorted(x, xmin, side="left") - 1, 0)
+    stop = min(np.searchsorted(x, xmax, side="right") + 1, len(x))
+    x, y = x[start:stop], y[start:stop]
+    n_bins = max(int(n_bins), 1)
+    if len(x) <= max(2 * n_bins, MIN_DECIMATE):
+        return x, y
+
+    per_bin = len(x) // n_bins
+    n = n_bins * per_bin
+    bins = y[:n].reshape(n_bins, per_bin)
+    offsets = np.arange(n_bins) * per_bin
+    # NaN (masked) pixels must not hide the rest of their bin
+    nan = np.isnan(bins)
+    lo = np.argmin(np.where(nan, np.inf, bins), axis=1) + offsets
+    hi = np.argmax(np.where(nan, -np.inf, bins), axis=1) + offsets
+    index = np.unique(np.concatenate([lo, hi, np.arange(n, len(x))]))
+    return x[index], y[index]
+
+
+class SpectrumPlot():
+    """
+    An interactive plot of a list of spectra, decimated to the screen.
+
+    Only the min/max envelope of the visible part of each spectrum, one bin
+    per horizontal pixel, is handed to matplotlib. The lines are animated:
+    full redraws (on zoom, pan or resize) only draw the axes, then the lines
+    are decimated again for the new limits and blitted on top.
+
+    Attributes:
+        fig (Figure): the figure.
+        ax (Axes): the axes.
+        arrays (list): wave, flux and err arrays of each spectrum, as returned
+            by `utils._spec_arrays`.
+        lines (list): (flux, err) lines of each spectrum.
+    """
+
+    def __init__(self, spec_list, title=None):
+        self.arrays = [utils._spec_arrays(_) for _ in spec_list]
+        self.fig, self.ax = plt.subplots(figsize=(10, 5))
+        if title is not None:
+            self.fig.canvas.manager.set_window_title(title)
+
+        self.lines = []
+        for n, arrays in enumerate(self.arrays):
+            order = np.argsort(arrays['wave'], kind="stable")
+            if np.any(order != np.arange(len(order))):
+                for key in ('wave', 'flux', 'err'):
+                    arrays[key] = arrays[key][order]
+            flux, = self.ax.plot([], [], lw=0.7, label=f"spec {n}", animated=True)
+            err, = self.ax.plot([], [], lw=0.5, color=flux.get_color(), alpha=0.5, animated=True)
+            self.lines.append((flux, err))
+
+        self._set_limits()
+        units = self.arrays[0]['units'] if self.arrays else {}
+        self.ax.set_xlabel(f"Wavelength [{units.get('wave') or '-'}]")
+        self.ax.set_ylabel(f"Flux [{units.get('flux') or '-'}]")
+        if len(self.lines) > 1:
+            self.ax.legend(handles=[_[0] for _ in self.lines], loc="upper right")
+        self.fig.canvas.mpl_connect("draw_event", self._on_draw)
+
+    def _set_limits(self):
+        waves = [_['wave'] for _ in self.arrays if len(_['wave'])]
+        if not waves:
+            return
+        self.ax.set_xlim(min(_[0] for _ in waves), max(_[-1] for _ in waves))
+        # robust limits: a few bad pixels shouldn't squash the spectrum
+        flux = np.concatenate([_['flux'] for _ in self.arrays])
+        lo, hi = np.nanpercentile(flux, [0.5, 99.5]) if np.isfinite(flux).any() else (0., 1.)
+        pad = 0.1 * (hi - lo) or 1.
+        self.ax.set_ylim(lo - pad, hi + pad)
+
+    def update_lines(self):
+        """
+        Decimates every spectrum for the current x limits of the axes.
+        """
+        xmin, xmax = self.ax.get_xlim()
+        n_bins = self.ax.bbox.width
+        for arrays, (flux, err) in zip(self.arrays, self.lines):
+            flux.set_data(*minmax_decimate(arrays['wave'], arrays['flux'], xmin, xmax, n_bins))
+            err.set_data(*minmax_decimate(arrays['wave'], arrays['err'], xmin, xmax, n_bins))
+
+    def _on_draw(self, event):
+        # the figure has just been drawn without the (animated) lines
+        self.update_lines()
+        for line in [_ for pair in self.lines for _ in pair]:
+            line.draw(event.renderer)
+        self.fig.canvas.blit(self.ax.bbox)
+
+    def show(self, block=False):
+        plt.show(block=block)
+
+
+def plot_spectra(spec_list, title=None, block=False):
+    """
+    Opens an interactive plot of a list of spectra.
+
+    Args:
+        spec_list (list): the spectra, as returned by the `sdb` searches.
+        title (str, optional): the window title.
+        block (bool, optional): wait until the window is closed.
+
+    Returns:
+        SpectrumPlot: the plot.
+    """
+    plot = SpectrumPlot(spec_list, title)
+    open_plots.append(plot)
+    plot.fig.canvas.mpl_connect("close_event", lambda event: open_plots.remove(plot))
+    plot.show(block)
+    return plot
+
+
+def close_all():
+    """
+    Closes the plots still open.
+    """
+    for plot in list(open_plots):
+        plt.close(plot.fig)
+    open_plots.clear()
@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import numpy as np
+
+import log
+from config import config
+
+RESULTS_SUFFIX = ".results.sqlite"
+
+# coordinates are rounded to about 4 mas and radii to 1 mas, so that the
+#  same search typed twice gets the same key
+COORD_DECIMALS = 6
+RADIUS_DECIMALS = 3
+
+
+def results_path(db_file):
+    """
+    Returns the path of the result cache of a database.
+
+    Args:
+        db_file (str): path of the database.
+
+    Returns:
+        str: path of the SQLite file.
+    """
+    return db_file + RESULTS_SUFFIX
+
+
+def normalize_cone(RA, DEC, tol):
+    """
+    Rounds a cone search, the rounded values are the ones searched.
+
+    Args:
+        RA (float): right ascension of the center (deg).
+        DEC (float): declination of the center (deg).
+        tol (float): search radius (arcsec).
+
+    Returns:
+        tuple: the rounded (RA, DEC, tol).
+    """
+    return (round(float(RA), COORD_DECIMALS), round(float(DEC), COORD_DECIMALS),
+            round(float(tol), RADIUS_DECIMALS))
+
+
+def cone_key(RA, DEC, tol):
+    """
+    Returns the cache key of a cone search, see `normalize_cone`.
+    """
+    return json.dumps(["cone", *normalize_cone(RA, DEC, tol)])
+
+
+def query_key(query=None, cone=None):
+    """
+    Returns the cache key of a metadata query, see `sdb.QubricsDB.query`.
+
+    Column names are case-insensitive, and the order of the constraints and
+    of the accepted values doesn't matter.
+    """
+    def value_key(value):
+        if isinstance(value, tuple):
+            return ["range", *value]
+        if isinstance(value, list):
+            return ["in", *sorted(value, key=repr)]
+        return ["eq", value]
+
+    constraints = sorted((key.lower(), value_key(value))
+                         for (key, value) in (query or {}).items())
+    cone = None if cone is None else normalize_cone(*cone)
+    return json.dumps(["query", constraints, cone], default=str)
+
+
+class ResultCache():
+    """
+    The rows matched by past searches of a database, kept on disk in a SQLite
+    file next to it so that repeated searches don't scan it again, also
+    across sessions.
+
+    Results are stored with the stamp of the database (see
+    `skyindex.db_stamp`): once the database changes they are not used
+    anymore, and they are deleted the next time it is opened. When the file
+    grows past `result_cache_mb` (see `config.yaml`) the least recently used
+    results are deleted. If the file can't be written the cache does nothing.
+
+    Attributes:
+        db_file (str): path of the database.
+        stamp (tuple): (mtime, size) of the database.
+        path (str): path of the SQLite file.
+        hits (int): number of searches found in the cache.
+        misses (int): number of searches not found in the cache.
+    """
+
+    def __init__(self, db_file, stamp):
+        self.db_file = db_file
+        self.stamp = tuple(stamp)
+        self.path = results_path(db_file)
+        self.hits = 0
+        self.misses = 0
+        self._key_stamp = json.dumps(list(self.stamp))
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self):
+        return int(config.get("result_cache_mb", 64) * 2**20)
+
+    def _connect(self):
+        # opened on first use, False if the cache can't be used
+        if self._conn is None:
+            try:
+                conn = sqlite3.connect(self.path, timeout=5., check_same_thread=False)
+                with conn:
+                    conn.execute("CREATE TABLE IF NOT EXISTS results (query TEXT PRIMARY KEY, "
+                                 "stamp TEXT, rows BLOB, size INTEGER, last_used REAL)")
+                    conn.execute("DELETE FROM results WHERE stamp != ?", (self._key_stamp,))
+                self._conn = conn
+            except (sqlite3.Error, OSError) as e:
+                log.logger.warning(f"Not caching the search results of {self.db_file}: {e}")
+                self._conn = False
+        return self._conn
+
+    def get(self, key):
+        """
+        Returns the rows of a search, if cached.
+
+        Args:
+            key (str): the search, see `cone_key` and `query_key`.
+
+        Returns:
+            ndarray: the row numbers, or None.
+        """
+        if self.max_bytes <= 0:
+            return None
+        with self._lock:
+            conn = self._connect()
+            if not conn:
+                return None
+            try:
+                with conn:
+                    found = conn.execute("SELECT rows FROM results WHERE query = ? AND stamp = ?",
+                                         (key, self._key_stamp)).fetchone()
+                    if found is not None:
+                        conn.execute("UPDATE results SET last_used = ? WHERE query = ?",
+                                     (time.time(), key))
+            except sqlite3.Error as e:
+                log.logger.warning(f"Could not read the result cache {self.path}: {e}")
+                return None
+        if found is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.frombuffer(found[0], dtype=np.int64).astype(np.intp)
+
+    def put(self, key, rows):
+        """
+        Stores the rows of a search, evicting old results if needed.
+
+        Args:
+            key (str): the search, see `cone_key` and `query_key`.
+            rows (ndarray): the row numbers.
+
+        Returns:
+            None.
+        """
+        blob = np.asarray(rows, dtype=np.int64).tobytes()
+        max_bytes = self.max_bytes
+        if max_bytes <= 0 or len(blob) > max_bytes:
+            return
+        with self._lock:
+            conn = self._connect()
+            if not conn:
+                return
+            try:
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                                 (key, self._key_stamp, blob, len(blob), time.time()))
+                    self._evict(conn, max_bytes)
+            except sqlite3.Error as e:
+                log.logger.warning(f"Could not write the result cache {self.path}: {e}")
+
+    def _evict(self, conn, max_bytes):
+        size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if size <= max_bytes:
+            return
+        evicted = []
+        for (key, _size) in conn.execute("SELECT query, size FROM results ORDER BY last_used"):
+            if size <= max_bytes:
+                break
+            evicted.append((key,))
+            size -= _size
+        conn.executemany("DELETE FROM results WHERE query = ?", evicted)
+
+    def rows(self, key, search):
+        """
+        Returns the rows of a search, running it only if not cached.
+
+        Args:
+            key (str): the search, see `cone_key` and `query_key`.
+            search (callable): runs the search, returns the row numbers.
+
+        Returns:
+            ndarray: the row numbers.
+        """
+        rows = self.get(key)
+        if rows is None:
+            rows = search()
+            self.put(key, rows)
+        return rows
+
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+            self._conn = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Manage the search result caches of QUBRICS formatted databases.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    clear = sub.add_parser("clear", help="Remove the result cache of the given databases.")
+    clear.add_argument("db_files", nargs="+", metavar="FILE")
+    args = parser.parse_args(argv)
+
+    for db_file in args.db_files:
+        if args.command == "clear" and os.path.isfile(results_path(db_file)):
+            os.remove(results_path(db_file))
+
+
+if __name__ == '__main__':
+    main()
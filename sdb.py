@@ -1,9 +1,29 @@
+import abc
+import log
 import utils
-import astropy.units as au
-import h5py
+import cache
+import skyindex
+import columns
+import resultcache
 import numpy as np
 
-from astropy.coordinates import SkyCoord
+from lazy import lazy_import
+
+# heavy dependencies, imported when first needed
+h5py = lazy_import("h5py")
+au = lazy_import("astropy.units")
+table = lazy_import("astropy.table")
+coordinates = lazy_import("astropy.coordinates")
+
+# loaded spectra, shared by all the databases (see `config.yaml`)
+spec_cache = cache.SpectrumCache()
+
+# spectra read at a time from search results, see `SearchResult.pages`
+PAGE_SIZE = 64
+
+
+class SearchCancelled(Exception):
+    pass
 
 
 class _SimpleSpec():
@@ -13,21 +33,428 @@ class _SimpleSpec():
     Attributes:
         data (dict): a dictionary to store wave, flux, and sig arrays.
         units (dict): a dictionary to store units for wave, flux, and sig.
+        raw (ndarray): the structured array `data` views into, if kept.
     """
 
     def __init__(self):
         self.data = {}
         self.units = {}
+        self.raw = None
+
+
+class QubricsDB():
+    """
+    A session on a QUBRICS formatted database.
+
+    The file is opened once and `Metadata` is read once, then kept in memory
+    as one array per column, so searches don't need to touch it again. Queries
+    are evaluated as boolean masks over the columns, range queries on the
+    `sorted_fields` use a sorted index built on first use.
+
+    If the database has a column sidecar (see `columns.py`) the columns are
+    memory-mapped from it instead: opening takes the same time whatever the
+    size of the catalog, searches only page in the parts of the columns they
+    touch, and processes opening the same database share them.
+
+    The rows matched by cone searches and queries are kept in a result cache
+    next to the database (see `resultcache.py`), repeating a search, also in
+    another session, doesn't scan the columns again.
+
+    Attributes:
+        db_file (str): path of the database.
+        stamp (tuple): (mtime, size) of the database when it was opened.
+        file (h5py.File): the open database.
+        meta (dict): the `Metadata` columns, keyed by field name.
+        qid (ndarray): the qid column.
+        ra (ndarray): right ascension (deg) of each row, as float64.
+        dec (ndarray): declination (deg) of each row, as float64.
+        qid_order (ndarray): the order sorting `qid`, to look qids up.
+        index (SkyIndex): the sky index of the database, loaded on first use.
+        results (ResultCache): the rows matched by past searches.
+    """
+
+    # name of the emission redshift column in `Metadata`
+    zem_field = "ZEM"
+    # columns getting a sorted index for range queries (plus the qid)
+    sorted_fields = ("ZEM",)
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.stamp = skyindex.db_stamp(db_file)
+        self.file = h5py.File(db_file, 'r')
+
+        try:
+            sidecar = columns.load_columns(db_file)
+            if sidecar is not None:
+                self.meta, self._qid_order = sidecar
+            else:
+                with log.timed("hdf5.read_metadata") as metrics:
+                    meta = self.file["Metadata"][:]
+                    metrics["bytes"], metrics["rows"] = meta.nbytes, len(meta)
+                self.meta = {name: np.ascontiguousarray(meta[name])
+                             for name in meta.dtype.names}
+                self._qid_order = None
+            self.qid = next(iter(self.meta.values()))
+            self.ra, self.dec = skyindex.read_radec(self.meta)
+        except BaseException:
+            # not a QUBRICS formatted file
+            self.file.close()
+            raise
+        self._index = None
+        self._sorted = {}
+        self.results = resultcache.ResultCache(db_file, self.stamp)
+
+    def __getitem__(self, key):
+        self._check_open()
+        return self.file[key]
+
+    def __contains__(self, key):
+        self._check_open()
+        return key in self.file
+
+    def _check_open(self):
+        # h5py reports a closed file as a missing key, which would look
+        #  like a qid without spectra
+        if not self.file:
+            raise ValueError(f"The database {self.db_file} was closed.")
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = skyindex.load_index(self.db_file, self.meta)
+        return self._index
+
+    @property
+    def qid_order(self):
+        if self._qid_order is None:
+            self._qid_order = np.argsort(self.qid, kind="stable")
+        return self._qid_order
+
+    def row(self, qid):
+        """
+        Returns the row of a qid in `Metadata`.
+
+        Args:
+            qid (str): the qid.
+
+        Raises:
+            KeyError: If the qid is not in `Metadata`.
+
+        Returns:
+            int: the row number.
+        """
+        try:
+            value = np.array(str(qid)).astype(self.qid.dtype)
+        except ValueError:
+            raise KeyError(qid)
+        n = np.searchsorted(self.qid, value, sorter=self.qid_order)
+        if n < len(self.qid) and self.qid[self.qid_order[n]] == value:
+            return int(self.qid_order[n])
+        raise KeyError(qid)
+
+    def redshift(self, qid):
+        """
+        Returns the emission redshift of a qid, from `Metadata`.
+
+        Args:
+            qid (str): the qid.
+
+        Raises:
+            KeyError: If the qid or the redshift column are not in `Metadata`.
+
+        Returns:
+            float: the redshift.
+        """
+        return float(self.meta[self.zem_field][self.row(qid)])
+
+    def cone(self, RA, DEC, tol):
+        """
+        Returns the rows within `tol` of a position.
+
+        Args:
+            RA (float): right ascension of the center (deg).
+            DEC (float): declination of the center (deg).
+            tol (float): search radius (arcsec).
+
+        Returns:
+            ndarray: the sorted row numbers.
+        """
+        RA, DEC, tol = resultcache.normalize_cone(RA, DEC, tol)
+        return self.results.rows(resultcache.cone_key(RA, DEC, tol),
+                                 lambda: self._cone(RA, DEC, tol))
+
+    def _cone(self, RA, DEC, tol):
+        # only compute the separation of the rows close enough in the index
+        rows = np.sort(self.index.candidates(RA, DEC, tol))
+        matches, _ = cone_search(RA, DEC, tol, self.ra[rows], self.dec[rows])
+        return rows[matches]
+
+    def query(self, query=None, cone=None):
+        """
+        Returns the rows matching a query on `Metadata`.
+
+        Every item of `query` is a constraint on a column (case-insensitive):
+        a (min, max) tuple is an inclusive range (None for an open end), a list
+        a set of accepted values, anything else a value to match exactly.
+
+        Args:
+            query (dict, optional): the constraints, all of them must be met.
+            cone (tuple, optional): a (RA, DEC, radius) constraint, in deg and
+                arcsec.
+
+        Raises:
+            InvalidInput: If a column is not in `Metadata`, or a constraint
+                doesn't match its type (e.g. a range on a string column).
+
+        Returns:
+            ndarray: the sorted row numbers.
+        """
+        if not query and cone is None:
+            return np.arange(len(self.qid))
+        return self.results.rows(resultcache.query_key(query, cone),
+                                 lambda: self._query(query, cone))
+
+    def _query(self, query, cone):
+        constraints = [(self._field(key), value)
+                       for (key, value) in (query or {}).items()]
+        for (name, value) in constraints:
+            _check_constraint(name, self.meta[name], value)
+
+        # start from the most restrictive thing that does not need a full scan
+        rows = None
+        if cone is not None:
+            rows = self.cone(*cone)
+        for (n, (name, value)) in enumerate(constraints):
+            if isinstance(value, tuple) and self._is_sorted_field(name):
+                _rows = self._range_rows(name, *value)
+                rows = _rows if rows is None else np.intersect1d(rows, _rows)
+                constraints[n] = None
+
+        mask = None
+        for constraint in constraints:
+            if constraint is None:
+                continue
+            name, value = constraint
+            column = self.meta[name] if rows is None else self.meta[name][rows]
+            _mask = _constraint_mask(column, value)
+            mask = _mask if mask is None else mask & _mask
+
+        if rows is None:
+            rows = np.arange(len(self.qid))
+        return rows if mask is None else rows[mask]
+
+    def _field(self, key):
+        names = {name.lower(): name for name in self.meta}
+        try:
+            return names[key.lower()]
+        except KeyError:
+            raise utils.InvalidInput(f"Unknown metadata column: {key}")
+
+    def _is_sorted_field(self, name):
+        return name in self.sorted_fields or self.meta[name] is self.qid
+
+    def _range_rows(self, name, lo, hi):
+        # sorted values and order of a column, built the first time they are needed
+        if name not in self._sorted:
+            order = (self.qid_order if self.meta[name] is self.qid
+                     else np.argsort(self.meta[name], kind="stable"))
+            self._sorted[name] = (self.meta[name][order], order)
+        values, order = self._sorted[name]
+        start = 0 if lo is None else np.searchsorted(values, lo, side="left")
+        stop = len(values) if hi is None else np.searchsorted(values, hi, side="right")
+        return np.sort(order[start:stop])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Closes the database file.
+        """
+        self.results.close()
+        self.file.close()
+
+
+def _constraint_mask(column, value):
+    """
+    Evaluates a query constraint on a `Metadata` column, see `QubricsDB.query`.
+
+    Args:
+        column (ndarray): the column.
+        value (obj): the constraint.
+
+    Returns:
+        ndarray: the boolean mask of the matching rows.
+    """
+    def as_column_type(_):
+        # numbers in the query are parsed as such, even for string columns
+        if column.dtype.kind in "SU" and not isinstance(_, str):
+            _ = str(_)
+        if column.dtype.kind == "S":
+            return _.encode()
+        return _
+
+    if isinstance(value, tuple):
+        lo, hi = value
+        mask = np.ones(len(column), dtype=bool)
+        if lo is not None:
+            mask &= column >= lo
+        if hi is not None:
+            mask &= column <= hi
+        return mask
+    if isinstance(value, (list, set)):
+        return np.isin(column, [as_column_type(_) for _ in value])
+    return column == as_column_type(value)
+
+
+def _check_constraint(name, column, value):
+    """
+    Checks that a query constraint can be evaluated on a `Metadata` column.
+
+    Raises:
+        InvalidInput: If the constraint doesn't match the type of the column.
+    """
+    numeric = column.dtype.kind in "iufb"
+    if isinstance(value, tuple):
+        if column.dtype.kind not in "iuf":
+            raise utils.InvalidInput(f"{name} is not numeric: it can't be queried with a range.")
+        return
+    if column.dtype.kind not in "iufbSU":
+        raise utils.InvalidInput(f"{name} can't be queried.")
+    values = value if isinstance(value, (list, set)) else [value]
+    for _ in values:
+        if numeric and isinstance(_, str):
+            raise utils.InvalidInput(f"{name} is numeric: '{_}' is not a number.")
+
+
+def open_db(db_file, is_qubrics=False):
+    """
+    Opens a SpecDB or QUBRICS database.
+
+    Args:
+        db_file (str): path of the database.
+        is_qubrics (bool, optional): whether the database is QUBRICS formatted.
+
+    Raises:
+        ModuleNotFoundError: If the database is a SpecDB one but SpecDB is
+            not installed.
+
+    Returns:
+        SpecDB or QubricsDB: the database object.
+    """
+    if is_qubrics:
+        return QubricsDB(db_file)
+    from specdb.specdb import SpecDB
+    return SpecDB(db_file=db_file)
+
+
+def is_qubrics_file(db_file):
+    """
+    Tells QUBRICS formatted databases from SpecDB ones, by their layout: a
+    top-level `Metadata` table rather than a `catalog`.
+
+    Args:
+        db_file (str): path of the database.
+
+    Returns:
+        bool: True if the database is QUBRICS formatted.
+    """
+    with h5py.File(db_file, 'r') as f:
+        return "Metadata" in f and "catalog" not in f
+
+
+def _wave_slice(dset, wave_min, wave_max):
+    """
+    Finds the pixels of a spectrum within a wavelength range.
+
+    The `wave` column is sorted, so a binary search reading one pixel at a
+    time is enough and the rest of the dataset is never read.
+
+    Args:
+        dset (h5py.Dataset): the compound spectrum dataset.
+        wave_min (float): lower end of the range.
+        wave_max (float): upper end of the range.
+
+    Returns:
+        slice: the pixels within [wave_min, wave_max].
+    """
+    wave = dset.fields('wave')
+
+    def bisect(value, right):
+        lo, hi = 0, dset.shape[0]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            w = wave[mid]
+            if w < value or (right and w == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
 
+    return slice(bisect(wave_min, False), bisect(wave_max, True))
 
-def _qubrics_spec_by_qid(qid, db):
+
+def _observed_range(qid, db, wave_range, rest_frame=False):
+    """
+    Converts a wavelength range to the observed frame of a qid.
+
+    Args:
+        qid (str): the qid.
+        db (QubricsDB): the QUBRICS database object.
+        wave_range (tuple): the (min, max) wavelength range, or None.
+        rest_frame (bool, optional): whether `wave_range` is in the rest frame.
+
+    Returns:
+        tuple: the observed-frame range, or None. Rest-frame ranges of qids
+            without a redshift are returned as None (full spectrum).
+    """
+    if wave_range is None or not rest_frame:
+        return wave_range
+    try:
+        z = db.redshift(qid)
+    except KeyError:
+        return None
+    return wave_range[0] * (1 + z), wave_range[1] * (1 + z)
+
+
+def _cache_key(db, *args):
+    """
+    Builds the `spec_cache` key of something read from a database.
+
+    Args:
+        db (database): a database instance.
+        *args: what identifies the data within the database.
+
+    Returns:
+        tuple: the key, or None if the database file is unknown.
+    """
+    if isinstance(db, QubricsDB):
+        return (db.db_file, db.stamp) + tuple(str(_) for _ in args)
+    db_file = getattr(db, "db_file", None)
+    if db_file is None:
+        return None
+    return (db_file, skyindex.db_stamp(db_file)) + tuple(str(_) for _ in args)
+
+
+def _qubrics_spec_by_qid(qid, db, keep_raw=False, wave_range=None):
     """
     Retrieve a list of SimpleSpec objects from the given database and qid.
 
+    Each spectrum is read from disk exactly once: wave, flux and sig are views
+    on the same structured array. With a wavelength range only the pixels in
+    the range are read. Spectra read through a `QubricsDB` are kept in
+    `spec_cache`.
+
     Args:
         qid (int): the QID for the data.
         db (database): a database instance.
-        config (duct): configuration.
+        keep_raw (bool, optional): keep the structured array on the spectra
+            (`raw` attribute), for zero-copy access. Defaults to False.
+        wave_range (tuple, optional): observed-frame (min, max) wavelength
+            range to read. Defaults to None (full spectrum).
 
     Returns:
         A tuple containing a list of SimpleSpec objects and the number of retrieved spectra.
@@ -35,21 +462,36 @@ def _qubrics_spec_by_qid(qid, db):
     # read data
     spec_list = []
     try:
-        for group in db[qid]:
-            # slightly more convoluted, just to have an organized objects and keep
-            #  the same interface I used for SpecDB
-            _ = _SimpleSpec()
-            _.data['wave'] = db[qid][group][:]['wave']
-            _.data['flux'] = db[qid][group][:]['flux']
-            _.data['sig'] = db[qid][group][:]['error']
-            _.units['wave'] = au.AA
-            _.units['flux'] = au.dimensionless_unscaled
-            _.units['sig'] = au.dimensionless_unscaled
-            spec_list.append(_)
-
-        return [spec_list], len(spec_list)
+        qid_group = db[qid]
     except KeyError:
         return [None], 0
+    for group in qid_group:
+        key = _cache_key(db, qid, group, wave_range)
+        raw = spec_cache.get(key) if key is not None else None
+        if raw is None:
+            with log.timed("hdf5.read_spectrum") as metrics:
+                dset = qid_group[group]
+                if wave_range is None:
+                    raw = dset[()]
+                else:
+                    raw = dset[_wave_slice(dset, *wave_range)]
+                metrics["bytes"], metrics["rows"] = raw.nbytes, len(raw)
+            if key is not None:
+                spec_cache.put(key, raw)
+        # slightly more convoluted, just to have an organized objects and keep
+        #  the same interface I used for SpecDB
+        _ = _SimpleSpec()
+        _.data['wave'] = raw['wave']
+        _.data['flux'] = raw['flux']
+        _.data['sig'] = raw['error']
+        _.units['wave'] = au.AA
+        _.units['flux'] = au.dimensionless_unscaled
+        _.units['sig'] = au.dimensionless_unscaled
+        if keep_raw:
+            _.raw = raw
+        spec_list.append(_)
+
+    return [spec_list], len(spec_list)
 
 
 def get_spectra(RA, DEC, sep, db):
@@ -65,12 +507,20 @@ def get_spectra(RA, DEC, sep, db):
     Returns:
         A list of SimpleSpec objects.
     """
+    key = _cache_key(db, "coord", RA, DEC, sep)
+    spectra = spec_cache.get(key) if key is not None else None
+    if spectra is not None:
+        return spectra
+
     if utils._is_number(RA):
-        return db.spectra_from_coord((RA, DEC), tol=sep*au.arcsec)
+        spectra = db.spectra_from_coord((RA, DEC), tol=sep*au.arcsec)
     else:
         if "-" not in DEC and "+" not in DEC:
             DEC = "+" + DEC
-        return db.spectra_from_coord(RA + DEC, tol=sep*au.arcsec)
+        spectra = db.spectra_from_coord(RA + DEC, tol=sep*au.arcsec)
+    if key is not None and spectra[0] is not None:
+        spec_cache.put(key, spectra)
+    return spectra
 
 
 def query_db(query, db):
@@ -85,44 +535,519 @@ def query_db(query, db):
         A list of SimpleSpec objects.
     """
     qmeta = db.query_meta(query)
-    return db.spectra_from_meta(qmeta, subset=True)
+
+    # the same rows give the same spectra, whatever the query was
+    key = None if qmeta is None else _cache_key(
+        db, "rows", *zip(qmeta['GROUP'], qmeta['GROUP_ID']))
+    spectra = spec_cache.get(key) if key is not None else None
+    if spectra is None:
+        spectra = db.spectra_from_meta(qmeta, subset=True)
+        if key is not None:
+            spec_cache.put(key, spectra)
+    return spectra
+
+
+def angular_separation(RA, DEC, ra, dec):
+    """
+    Computes the angular separation between a position and a set of positions.
+
+    Uses the Vincenty formula, the same astropy uses in `SkyCoord.separation`,
+    which is accurate at all separations.
+
+    Args:
+        RA (float or ndarray): right ascension of the center (deg). An array
+            is matched element-wise against `ra`.
+        DEC (float or ndarray): declination of the center (deg).
+        ra (ndarray): right ascensions (deg).
+        dec (ndarray): declinations (deg).
+
+    Returns:
+        ndarray: separations in arcseconds.
+    """
+    d_ra = np.radians(ra - RA)
+    sin_d_ra, cos_d_ra = np.sin(d_ra), np.cos(d_ra)
+    sin_1, cos_1 = np.sin(np.radians(DEC)), np.cos(np.radians(DEC))
+    _dec = np.radians(dec)
+    sin_2, cos_2 = np.sin(_dec), np.cos(_dec)
+
+    num_1 = cos_2 * sin_d_ra
+    num_2 = cos_1 * sin_2 - sin_1 * cos_2 * cos_d_ra
+    denominator = sin_1 * sin_2 + cos_1 * cos_2 * cos_d_ra
+    return np.degrees(np.arctan2(np.hypot(num_1, num_2), denominator)) * 3600.
+
+
+def cone_search(RA, DEC, radius, ra, dec, chunk_size=None):
+    """
+    Finds the positions within `radius` of a given center.
+
+    Args:
+        RA (float): right ascension of the center (deg).
+        DEC (float): declination of the center (deg).
+        radius (float): search radius (arcsec).
+        ra (ndarray): right ascensions to search (deg), as float64.
+        dec (ndarray): declinations to search (deg), as float64.
+        chunk_size (int, optional): number of positions processed at once, to
+            keep memory bounded on very large tables. Defaults to None (all).
+
+    Returns:
+        tuple: indices of the matching positions and their separations (arcsec).
+    """
+    n = len(ra)
+    if chunk_size is None or chunk_size <= 0:
+        chunk_size = max(n, 1)
+
+    indices, separations = [], []
+    for start in range(0, n, chunk_size):
+        sep = angular_separation(RA, DEC, ra[start:start + chunk_size],
+                                 dec[start:start + chunk_size])
+        match = np.where(sep < radius)[0]
+        indices.append(match + start)
+        separations.append(sep[match])
+
+    if len(indices) == 0:
+        return np.array([], dtype=np.intp), np.array([])
+    return np.concatenate(indices), np.concatenate(separations)
+
+
+def _check_cancel(cancel):
+    """
+    Stops a search if it was cancelled.
+
+    Args:
+        cancel (threading.Event): set to cancel the search, or None.
+
+    Raises:
+        SearchCancelled: If `cancel` is set.
+    """
+    if cancel is not None and cancel.is_set():
+        raise SearchCancelled("Search cancelled.")
+
+
+def _center_deg(RA, DEC):
+    """
+    Converts the coordinates returned by `utils.parse_input` to degrees.
+
+    Args:
+        RA (str or float): right ascension, sexagesimal or in degrees.
+        DEC (str or float): declination, sexagesimal or in degrees.
+
+    Returns:
+        tuple: right ascension and declination in degrees.
+    """
+    if utils._is_number(RA):
+        return float(RA), float(DEC)
+    c_1 = coordinates.SkyCoord(ra=RA, dec=DEC, frame='icrs', unit=(au.hourangle, au.deg))
+    return c_1.ra.deg, c_1.dec.deg
+
+
+class SearchResult(abc.ABC):
+    """
+    The matches of a search, whose spectra are only read when asked for.
+
+    Counting the spectra and getting the metadata of the matches don't read
+    any spectrum. `pages` and `iter_spectra` read them as they are consumed,
+    so that memory use depends on the page size and not on the number of
+    matches; `to_list` reads them all, as the `search_*` functions do.
+    """
+
+    @abc.abstractmethod
+    def count(self):
+        """
+        Returns the number of spectra matched, without reading them.
+        """
+
+    @abc.abstractmethod
+    def pages(self, page_size=PAGE_SIZE, progress=None, cancel=None):
+        """
+        Reads the spectra a page at a time.
+
+        Args:
+            page_size (int, optional): spectra per page (the last one can be
+                smaller, pages of QUBRICS results can be larger to keep the
+                spectra of a qid together).
+            progress (callable, optional): called with the completed fraction.
+            cancel (threading.Event, optional): set it to stop reading.
+
+        Raises:
+            SearchCancelled: If `cancel` is set.
+
+        Yields:
+            list: the spectra of a page.
+        """
+
+    @abc.abstractmethod
+    def object_ids(self):
+        """
+        Returns the object each spectrum belongs to, in the order of
+        `iter_spectra`, without reading the spectra (e.g. to co-add the
+        spectra of each object, see `coadd.coadd`).
+        """
+
+    def iter_spectra(self, progress=None, cancel=None):
+        """
+        Yields the spectra one at a time, reading them a page at a time.
+        """
+        for page in self.pages(progress=progress, cancel=cancel):
+            yield from page
+
+    def to_list(self, progress=None, cancel=None):
+        """
+        Reads all the spectra.
+
+        Returns:
+            tuple: the spectra and their number, as returned by the `search_*`
+                functions.
+        """
+        spec_list = []
+        for page in self.pages(progress=progress, cancel=cancel):
+            spec_list.extend(page)
+        if not spec_list:
+            return [None], 0
+        return [spec_list], len(spec_list)
+
+
+class QubricsResult(SearchResult):
+    """
+    The matches of a search in a QUBRICS database.
+
+    Attributes:
+        db (QubricsDB): the database.
+        qids (list): the qids matched, as strings.
+        rows (ndarray): their rows in `Metadata` (qids not in `Metadata`,
+            searched by qid, have none).
+        wave_range (tuple): (min, max) wavelength range to read, or None.
+        rest_frame (bool): whether `wave_range` is in the rest frame.
+    """
+
+    def __init__(self, db, rows, qids=None, wave_range=None, rest_frame=False):
+        self.db = db
+        self.rows = np.asarray(rows, dtype=np.intp)
+        self.qids = list(db.qid[self.rows].astype("str")) if qids is None else list(qids)
+        self.wave_range = wave_range
+        self.rest_frame = rest_frame
+        self._counts = None
+
+    @property
+    def meta(self):
+        """
+        The `Metadata` columns of the matched rows, by name.
+        """
+        return {name: column[self.rows] for (name, column) in self.db.meta.items()}
+
+    def counts(self):
+        """
+        Returns the number of spectra of each qid, from the file structure only.
+        """
+        if self._counts is None:
+            db = self.db
+            self._counts = np.array([len(db[qid]) if qid in db else 0
+                                     for qid in self.qids], dtype=np.intp)
+        return self._counts
+
+    def count(self):
+        return int(self.counts().sum())
+
+    def object_ids(self):
+        return np.repeat(self.qids, self.counts())
+
+    def _read(self, qid):
+        wave_range = _observed_range(qid, self.db, self.wave_range, self.rest_frame)
+        # qids without spectra give None
+        return _qubrics_spec_by_qid(qid, self.db, wave_range=wave_range)[0][0] or []
+
+    def pages(self, page_size=PAGE_SIZE, progress=None, cancel=None):
+        page = []
+        for n, qid in enumerate(self.qids):
+            _check_cancel(cancel)
+            if progress is not None:
+                progress(n / len(self.qids))
+            page.extend(self._read(qid))
+            if len(page) >= page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def page(self, number, page_size=PAGE_SIZE):
+        """
+        Reads one page of spectra, without reading the previous ones.
+
+        Args:
+            number (int): the page, from 0.
+            page_size (int, optional): spectra per page.
+
+        Returns:
+            list: the spectra of the page, empty past the last one.
+        """
+        first, last = number * page_size, (number + 1) * page_size
+        ends = np.cumsum(self.counts())
+        starts = ends - self.counts()
+        spec_list = []
+        for n in np.nonzero((ends > first) & (starts < last))[0]:
+            spectra = self._read(self.qids[n])
+            spec_list.extend(spectra[max(first - starts[n], 0):last - starts[n]])
+        return spec_list
+
+
+class SpecDBResult(SearchResult):
+    """
+    The matches of a search in a SpecDB database.
+
+    Attributes:
+        db (SpecDB): the database.
+        meta (Table): the SpecDB metadata of the matched spectra, or None.
+    """
+
+    def __init__(self, db, meta):
+        self.db = db
+        self.meta = meta
+
+    def count(self):
+        return 0 if self.meta is None else len(self.meta)
+
+    def object_ids(self):
+        if self.meta is None:
+            return np.array([])
+        return np.asarray(self.meta[self.db.qcat.idkey])
+
+    def pages(self, page_size=PAGE_SIZE, progress=None, cancel=None):
+        for start in range(0, self.count(), page_size):
+            _check_cancel(cancel)
+            if progress is not None:
+                progress(start / self.count())
+            spectra = self.db.spectra_from_meta(self.meta[start:start + page_size], subset=True)
+            yield list(spectra[0])
 
 
 # Search functions
-def _search_qubrics_by_coord(values, db, config):
+@log.traced("sdb.search_qid", rows=lambda result: result[1])
+def search_qid(qid, db, is_qubrics=False, wave_range=None, rest_frame=False):
+    """
+    Searches for the spectra of a qid.
+
+    Parameters:
+    -----------
+    qid : int or str
+        The qid.
+    db : SpecDB or QubricsDB
+        The database object.
+    is_qubrics : bool, optional
+        A flag indicating whether to search the QUBRICS database or not.
+    wave_range : tuple, optional
+        (min, max) wavelength range to read, QUBRICS databases only.
+    rest_frame : bool, optional
+        Whether `wave_range` is in the rest frame of the qid.
+
+    Returns:
+    --------
+    tuple
+        A tuple containing a list of spectra and the number of spectra
+        found.
+    """
+    if is_qubrics:
+        qid = str(qid)
+        wave_range = _observed_range(qid, db, wave_range, rest_frame)
+        return _qubrics_spec_by_qid(qid, db, wave_range=wave_range)
+    return _search_by_query({'qid': utils.parse_qid(qid)}, db)
+
+
+@log.traced("sdb.search_coord", rows=lambda result: result[1])
+def search_coord(RA, DEC, tol, db, is_qubrics=False, wave_range=None,
+                 rest_frame=False, progress=None, cancel=None):
+    """
+    Searches for spectra within a matching radius of a position.
+
+    Parameters:
+    -----------
+    RA : str or float
+        Right ascension, sexagesimal or in degrees (see `utils.parse_input`).
+    DEC : str or float
+        Declination, sexagesimal or in degrees.
+    tol : float
+        Matching radius in arcseconds.
+    db : SpecDB or QubricsDB
+        The database object.
+    is_qubrics : bool, optional
+        A flag indicating whether to search the QUBRICS database or not.
+    wave_range : tuple, optional
+        (min, max) wavelength range to read, QUBRICS databases only.
+    rest_frame : bool, optional
+        Whether `wave_range` is in the rest frame of each qid.
+    progress : callable, optional
+        Called with the completed fraction of the search.
+    cancel : threading.Event, optional
+        Set it to cancel the search.
+
+    Returns:
+    --------
+    tuple
+        A tuple containing a list of spectra and the number of spectra
+        found.
+    """
+    if is_qubrics:
+        return find_coord(RA, DEC, tol, db, True, wave_range, rest_frame).to_list(
+            progress, cancel)
+
+    spectra = get_spectra(RA, DEC, tol, db)
+    if spectra[0] is None:
+        n_spec = 0
+    else:
+        n_spec = spectra[0].nspec
+    return spectra, n_spec
+
+
+@log.traced("sdb.search_query", rows=lambda result: result[1])
+def search_query(query, db, is_qubrics=False, cone=None, wave_range=None,
+                 rest_frame=False, progress=None, cancel=None):
+    """
+    Searches for spectra matching a metadata query.
+
+    Parameters:
+    -----------
+    query : dict
+        The query, see `QubricsDB.query` and `utils.parse_query`. SpecDB
+        databases get it as a SpecDB query dictionary.
+    db : SpecDB or QubricsDB
+        The database object.
+    is_qubrics : bool, optional
+        A flag indicating whether to search the QUBRICS database or not.
+    cone : tuple, optional
+        (RA, DEC, radius) constraint in deg and arcsec, QUBRICS databases only.
+    wave_range : tuple, optional
+        (min, max) wavelength range to read, QUBRICS databases only.
+    rest_frame : bool, optional
+        Whether `wave_range` is in the rest frame of each qid.
+    progress : callable, optional
+        Called with the completed fraction of the search.
+    cancel : threading.Event, optional
+        Set it to cancel the search.
+
+    Returns:
+    --------
+    tuple
+        A tuple containing a list of spectra and the number of spectra
+        found.
+    """
+    if is_qubrics:
+        return find_query(query, db, True, cone, wave_range, rest_frame).to_list(
+            progress, cancel)
+    if cone is not None:
+        raise utils.InvalidInput(
+            "Queries with coordinates are only supported on QUBRICS databases.")
+    return _search_by_query(query, db)
+
+
+def find_qid(qid, db, is_qubrics=False, wave_range=None, rest_frame=False):
+    """
+    Finds the spectra of a qid, without reading them (see `search_qid`).
+
+    Returns:
+        SearchResult: the matches.
+    """
+    if is_qubrics:
+        qid = str(qid)
+        try:
+            rows = [db.row(qid)]
+        except KeyError:
+            rows = []
+        return QubricsResult(db, rows, [qid], wave_range, rest_frame)
+    try:
+        return SpecDBResult(db, db.query_meta({'qid': utils.parse_qid(qid)}))
+    except AttributeError:
+        return SpecDBResult(db, None)
+
+
+def find_coord(RA, DEC, tol, db, is_qubrics=False, wave_range=None, rest_frame=False):
+    """
+    Finds the spectra within a matching radius of a position, without
+    reading them (see `search_coord`).
+
+    Returns:
+        SearchResult: the matches.
+    """
+    if is_qubrics:
+        rows = db.cone(*_center_deg(RA, DEC), tol)
+        return QubricsResult(db, rows, wave_range=wave_range, rest_frame=rest_frame)
+    if not utils._is_number(RA) and "-" not in DEC and "+" not in DEC:
+        DEC = "+" + DEC
+    position = (RA, DEC) if utils._is_number(RA) else RA + DEC
+    return SpecDBResult(db, db.meta_from_position(position, tol=tol*au.arcsec))
+
+
+def find_query(query, db, is_qubrics=False, cone=None, wave_range=None, rest_frame=False):
+    """
+    Finds the spectra matching a metadata query, without reading them (see
+    `search_query`).
+
+    Returns:
+        SearchResult: the matches.
+    """
+    if is_qubrics:
+        rows = db.query(query, cone)
+        return QubricsResult(db, rows, wave_range=wave_range, rest_frame=rest_frame)
+    if cone is not None:
+        raise utils.InvalidInput(
+            "Queries with coordinates are only supported on QUBRICS databases.")
+    try:
+        return SpecDBResult(db, db.query_meta(query))
+    except AttributeError:
+        return SpecDBResult(db, None)
+
+
+def _wave_values(values):
+    """
+    Parses the wavelength range in the GUI values.
+
+    Returns:
+        tuple: the (min, max) range, or None, and the rest frame flag.
+    """
+    wave_range = utils.parse_wave_range(
+        values.get('-WAVE_MIN-', ""), values.get('-WAVE_MAX-', ""))
+    return wave_range, values.get('-REST_FRAME-', False)
+
+
+def _has_coordinates(values):
+    return any(values.get(key, "") != ""
+               for key in ('-RA_HMS-', '-DEC_DMS-', '-RA_DEC-', '-DEC_DEG-'))
+
+
+def _search_qubrics_by_coord(values, db, config, progress=None, cancel=None):
     RA, DEC, tol = utils.parse_input(
         values['-RA_HMS-'], values['-DEC_DMS-'],
         values['-RA_DEC-'], values['-DEC_DEG-'],
         values['-MATCH_R-'])
+    return search_coord(RA, DEC, tol, db, True, *_wave_values(values),
+                        progress=progress, cancel=cancel)
 
-    db = h5py.File(config["active_db"], 'r')
-    meta = db["Metadata"][:]
 
-    # search spectra
-    if utils._is_number(RA):
-        c_1 = SkyCoord(ra=float(RA), dec=float(DEC),
-                       frame='icrs', unit=(au.deg, au.deg))
-    else:
-        c_1 = SkyCoord(ra=RA, dec=DEC, frame='icrs',
-                       unit=(au.hourangle, au.deg))
-
-    sep = np.array([])
-    for i in range(len(meta.T)):
-        _ra = meta.T[i][4]
-        _dec = meta.T[i][5]
-        c_2 = SkyCoord(ra=float(_ra), dec=float(_dec),
-                       frame='icrs', unit=(au.deg, au.deg))
-        sep = np.concatenate((sep, [c_1.separation(c_2).arcsec]))
-
-    file_indices = np.where(sep < tol)[0]
-    if len(file_indices) > 0:
-        spec_list = []
-        for i in file_indices:
-            qid = (meta.T[i][0]).astype("str")
-            spec_list = spec_list + _qubrics_spec_by_qid(qid, db)[0][0]
-        return [spec_list], len(spec_list)
-    else:
-        return [None], 0
+def _search_qubrics_by_query(values, db, config, progress=None, cancel=None):
+    """
+    Searches for spectra in the QUBRICS database matching a metadata query,
+    optionally within a cone if coordinates are provided too.
+
+    Parameters:
+    -----------
+    values : dict
+        A dictionary of values containing the query and the input coordinates.
+    db : QubricsDB
+        The QUBRICS database object.
+
+    Returns:
+    --------
+    tuple
+        A tuple containing a list of spectra and the number of spectra
+        found.
+    """
+    query = utils.parse_query(values['-QUERY-'])
+    cone = None
+    if _has_coordinates(values):
+        RA, DEC, tol = utils.parse_input(
+            values['-RA_HMS-'], values['-DEC_DMS-'],
+            values['-RA_DEC-'], values['-DEC_DEG-'],
+            values['-MATCH_R-'])
+        cone = _center_deg(RA, DEC) + (tol,)
+    return search_query(query, db, True, cone, *_wave_values(values),
+                        progress=progress, cancel=cancel)
 
 
 def _search_specdb_by_coord(values, db):
@@ -147,12 +1072,7 @@ def _search_specdb_by_coord(values, db):
         values['-RA_HMS-'], values['-DEC_DMS-'],
         values['-RA_DEC-'], values['-DEC_DEG-'],
         values['-MATCH_R-'])
-    spectra = get_spectra(RA, DEC, tol, db)
-    if spectra[0] is None:
-        n_spec = 0
-    else:
-        n_spec = spectra[0].nspec
-    return spectra, n_spec
+    return search_coord(RA, DEC, tol, db)
 
 
 def _search_qubrics_by_qid(values, db, config):
@@ -172,8 +1092,7 @@ def _search_qubrics_by_qid(values, db, config):
         A tuple containing a list of spectra and the number of spectra
         found.
     """
-    with h5py.File(config["active_db"], 'r') as db:
-        return _qubrics_spec_by_qid(values["-QID-"], db)
+    return search_qid(values["-QID-"], db, True, *_wave_values(values))
 
 
 def _search_by_query(query, db):
@@ -203,7 +1122,7 @@ def _search_by_query(query, db):
             n_spec = spectra[0].nspec
         return spectra, n_spec
     except AttributeError:
-        return None, 0
+        return [None], 0
 
 
 def _search_by_qid(values, db):
@@ -223,24 +1142,125 @@ def _search_by_qid(values, db):
         A tuple containing a list of spectra and the number of spectra 
         found.
     """
-    qid = utils.parse_qid(values["-QID-"])
-    query = {'qid': qid}
-    return _search_by_query(query, db)
+    return search_qid(values["-QID-"], db)
+
+
+def _batch_qubrics(RA, DEC, tol, db):
+    """
+    Cross-matches a target list against a QUBRICS database in one pass.
+
+    Args:
+        RA (ndarray): right ascensions of the targets (deg).
+        DEC (ndarray): declinations of the targets (deg).
+        tol (ndarray): matching radius of each target (arcsec).
+        db (QubricsDB): the QUBRICS database object.
+
+    Returns:
+        Table: one row per match, with the target index, qid, row in
+            `Metadata` and separation (arcsec).
+    """
+    targets, rows = db.index.candidate_pairs(RA, DEC, tol)
+    sep = angular_separation(RA[targets], DEC[targets], db.ra[rows], db.dec[rows])
+    match = sep < tol[targets]
+    matches = table.Table([targets[match], db.qid[rows[match]], rows[match], sep[match]],
+                          names=("target", "ID", "row", "sep"))
+    matches.sort(["target", "sep"])
+    return matches
 
 
-def search_spectra(values, db, is_qubrics=False, config=None):
+def _batch_specdb(RA, DEC, tol, db):
+    """
+    Cross-matches a target list against a SpecDB database in one pass.
+
+    SpecDB only returns the closest catalog entry for each target.
+
+    Args:
+        RA (ndarray): right ascensions of the targets (deg).
+        DEC (ndarray): declinations of the targets (deg).
+        tol (ndarray): matching radius of each target (arcsec).
+        db (SpecDB): the SpecDB database object.
+
+    Returns:
+        Table: one row per match, with the target index, catalog ID and
+            separation (arcsec).
+    """
+    coords = coordinates.SkyCoord(ra=RA, dec=DEC, frame='icrs', unit=(au.deg, au.deg))
+    IDs = np.asarray(db.qcat.match_coord(
+        coords, toler=np.max(tol) * au.arcsec, verbose=False))
+    targets = np.where(IDs >= 0)[0]
+
+    cat = db.qcat.cat
+    cat_ids = np.asarray(cat[db.qcat.idkey])
+    sorter = np.argsort(cat_ids)
+    rows = sorter[np.searchsorted(cat_ids, IDs[targets], sorter=sorter)]
+    sep = angular_separation(RA[targets], DEC[targets],
+                             np.asarray(cat['RA'], dtype=np.float64)[rows],
+                             np.asarray(cat['DEC'], dtype=np.float64)[rows])
+
+    # the catalog match used the largest radius, apply the per-target ones
+    match = sep < tol[targets]
+    return table.Table([targets[match], IDs[targets][match], sep[match]],
+                       names=("target", "ID", "sep"))
+
+
+@log.traced("sdb.batch_search", rows=len)
+def batch_search(RA, DEC, tol, db, is_qubrics=False, config=None):
+    """
+    Cross-matches a whole target list against the SpecDB or QUBRICS database.
+
+    Parameters:
+    -----------
+    RA : ndarray
+        Right ascensions of the targets (deg), see `utils.parse_targets`.
+    DEC : ndarray
+        Declinations of the targets (deg).
+    tol : ndarray
+        Matching radius of each target (arcsec).
+    db : SpecDB or QubricsDB
+        The database object.
+    is_qubrics : bool, optional
+        A flag indicating whether to search the QUBRICS database or not.
+
+    Returns:
+    --------
+    Table
+        The match table: the `target` column is the row of the target list,
+        `ID` the qid (or SpecDB ID) of the match and `sep` its separation in
+        arcseconds.
+    """
+    if is_qubrics:
+        return _batch_qubrics(RA, DEC, tol, db)
+    else:
+        return _batch_specdb(RA, DEC, tol, db)
+
+
+def search_spectra(values, db, is_qubrics=False, config=None, progress=None, cancel=None):
     """
     Searches for spectra in the SpecDB or QUBRICS database based on the 
     provided values.
 
+    The search can be run on a worker thread: `progress` is called with the
+    completed fraction, and setting `cancel` stops the search as soon as
+    possible (SpecDB searches can only be stopped once SpecDB returns).
+
     Parameters:
     -----------
     values : dict
-        A dictionary of values containing the input coordinates or qid.
+        A dictionary of values containing the input coordinates, qid or
+        metadata query (see `utils.parse_query`).
     db : SpecDB or QubricsDB
         The database object.
     is_qubrics : bool, optional
         A flag indicating whether to search the QUBRICS database or not.
+    progress : callable, optional
+        Called with the completed fraction of the search, in [0, 1].
+    cancel : threading.Event, optional
+        Set it to cancel the search.
+
+    Raises:
+    -------
+    SearchCancelled
+        If the search was cancelled.
 
     Returns:
     --------
@@ -248,11 +1268,49 @@ def search_spectra(values, db, is_qubrics=False, config=None):
         A tuple containing a list of spectra and the number of spectra 
         found.
     """
-    if values["-QID-"] != "" and is_qubrics:
-        return _search_qubrics_by_qid(values, db, config)
+    _check_cancel(cancel)
+    if values.get("-QUERY-", "") != "" and is_qubrics:
+        result = _search_qubrics_by_query(values, db, config, progress, cancel)
+    elif values.get("-QUERY-", "") != "" and not is_qubrics:
+        result = search_query(utils.parse_query(values["-QUERY-"]), db)
+    elif values["-QID-"] != "" and is_qubrics:
+        result = _search_qubrics_by_qid(values, db, config)
     elif values["-QID-"] != "" and not is_qubrics:
-        return _search_by_qid(values, db)
+        result = _search_by_qid(values, db)
     elif values["-QID-"] == "" and is_qubrics:
-        return _search_qubrics_by_coord(values, db, config)
+        result = _search_qubrics_by_coord(values, db, config, progress, cancel)
     elif values["-QID-"] == "" and not is_qubrics:
-        return _search_specdb_by_coord(values, db)
+        result = _search_specdb_by_coord(values, db)
+
+    _check_cancel(cancel)
+    if progress is not None:
+        progress(1.)
+    return result
+
+
+def find_spectra(values, db, is_qubrics=False, config=None):
+    """
+    Finds the spectra matching the GUI values, like `search_spectra`, but
+    without reading them: the spectra are read from the result as needed.
+
+    Returns:
+        SearchResult: the matches.
+    """
+    wave_range, rest_frame = _wave_values(values)
+    if values.get("-QUERY-", "") != "":
+        cone = None
+        if is_qubrics and _has_coordinates(values):
+            RA, DEC, tol = utils.parse_input(
+                values['-RA_HMS-'], values['-DEC_DMS-'],
+                values['-RA_DEC-'], values['-DEC_DEG-'],
+                values['-MATCH_R-'])
+            cone = _center_deg(RA, DEC) + (tol,)
+        return find_query(utils.parse_query(values["-QUERY-"]), db, is_qubrics,
+                          cone, wave_range, rest_frame)
+    if values["-QID-"] != "":
+        return find_qid(values["-QID-"], db, is_qubrics, wave_range, rest_frame)
+    RA, DEC, tol = utils.parse_input(
+        values['-RA_HMS-'], values['-DEC_DMS-'],
+        values['-RA_DEC-'], values['-DEC_DEG-'],
+        values['-MATCH_R-'])
+    return find_coord(RA, DEC, tol, db, is_qubrics, wave_range, rest_frame)
@@ -0,0 +1,269 @@
+import os
+import argparse
+import numpy as np
+
+import log
+from lazy import lazy_import
+
+h5py = lazy_import("h5py")
+
+# position of the relevant columns in the QUBRICS `Metadata` table
+RA_FIELD = 4
+DEC_FIELD = 5
+
+INDEX_SUFFIX = ".skyidx.npz"
+
+
+class SkyIndex():
+    """
+    A declination-sorted index over the coordinates of a QUBRICS database.
+
+    Attributes:
+        order (ndarray): row numbers of `Metadata`, sorted by declination.
+        ra (ndarray): right ascension (deg) of each row, in `order`.
+        dec (ndarray): declination (deg) of each row, sorted.
+        stamp (tuple): (mtime, size) of the database the index was built from.
+    """
+
+    def __init__(self, order, ra, dec, stamp=(0, 0)):
+        self.order = order
+        self.ra = ra
+        self.dec = dec
+        self.stamp = tuple(int(_) for _ in stamp)
+
+    @classmethod
+    def from_metadata(cls, meta, stamp=(0, 0)):
+        """
+        Builds the index from a `Metadata` table.
+
+        Args:
+            meta (ndarray or dict): the `Metadata` table, see `read_radec`.
+            stamp (tuple, optional): (mtime, size) of the database file.
+
+        Returns:
+            SkyIndex: the new index.
+        """
+        ra, dec = read_radec(meta)
+        order = np.argsort(dec, kind="stable")
+        return cls(order, ra[order], dec[order], stamp)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an index from a sidecar file.
+
+        Args:
+            path (str): path of the sidecar file.
+
+        Returns:
+            SkyIndex: the loaded index.
+        """
+        with np.load(path) as f:
+            return cls(f["order"], f["ra"], f["dec"], tuple(f["stamp"]))
+
+    def save(self, path):
+        """
+        Saves the index to a sidecar file.
+
+        The file is written next to its final location and renamed, so readers
+        never see a partially written index.
+
+        Args:
+            path (str): path of the sidecar file.
+
+        Returns:
+            None.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, order=self.order, ra=self.ra, dec=self.dec,
+                     stamp=np.array(self.stamp, dtype=np.int64))
+        os.replace(tmp_path, path)
+
+    def is_stale(self, db_file):
+        """
+        Checks if the database changed since the index was built.
+
+        Args:
+            db_file (str): path of the database.
+
+        Returns:
+            bool: True if the index does not match the database anymore.
+        """
+        return self.stamp != db_stamp(db_file)
+
+    def candidates(self, RA, DEC, radius):
+        """
+        Returns the rows that may fall within `radius` of the given position.
+
+        Only a declination band and, away from the poles, a right ascension
+        window are checked: the exact separation still has to be computed on
+        the returned rows.
+
+        Args:
+            RA (float): right ascension of the center (deg).
+            DEC (float): declination of the center (deg).
+            radius (float): search radius (arcsec).
+
+        Returns:
+            ndarray: row numbers of `Metadata`.
+        """
+        r = radius / 3600.
+        lo = np.searchsorted(self.dec, DEC - r, side="left")
+        hi = np.searchsorted(self.dec, DEC + r, side="right")
+        rows = self.order[lo:hi]
+
+        # close to the poles every right ascension can be within the radius
+        max_dec = abs(DEC) + r
+        if max_dec >= 90. or r >= 180.:
+            return rows
+
+        d_ra = np.degrees(np.arcsin(
+            min(1., np.sin(np.radians(r)) / np.cos(np.radians(max_dec)))))
+        delta = np.abs((self.ra[lo:hi] - RA + 180.) % 360. - 180.)
+        return rows[delta <= d_ra]
+
+    def candidate_pairs(self, RA, DEC, radius):
+        """
+        Vectorized version of `candidates` over a list of positions.
+
+        Args:
+            RA (ndarray): right ascensions of the centers (deg).
+            DEC (ndarray): declinations of the centers (deg).
+            radius (ndarray): search radius of each center (arcsec).
+
+        Returns:
+            tuple: for every candidate pair, the index of the center and the
+                row number in `Metadata`.
+        """
+        r = np.asarray(radius, dtype=np.float64) / 3600.
+        lo = np.searchsorted(self.dec, DEC - r, side="left")
+        hi = np.searchsorted(self.dec, DEC + r, side="right")
+        counts = hi - lo
+
+        # expand each [lo, hi) band into explicit (center, position) pairs
+        centers = np.repeat(np.arange(len(lo)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        positions = lo[centers] + offsets
+
+        # same right ascension cut as `candidates`, disabled close to the poles
+        max_dec = np.abs(DEC) + r
+        with np.errstate(invalid="ignore", divide="ignore"):
+            d_ra = np.degrees(np.arcsin(np.minimum(
+                1., np.sin(np.radians(r)) / np.cos(np.radians(max_dec)))))
+        d_ra[(max_dec >= 90.) | (r >= 180.)] = 360.
+        delta = np.abs((self.ra[positions] - RA[centers] + 180.) % 360. - 180.)
+        keep = delta <= d_ra[centers]
+        return centers[keep], self.order[positions[keep]]
+
+
+def read_radec(meta):
+    """
+    Reads the RA and DEC columns of a `Metadata` table.
+
+    Args:
+        meta (ndarray or dict): the `Metadata` structured array, or its
+            columns by name, in order.
+
+    Returns:
+        tuple: right ascension and declination (deg) as float64 arrays.
+    """
+    names = meta.dtype.names if hasattr(meta, "dtype") else list(meta)
+    return (np.asarray(meta[names[RA_FIELD]], dtype=np.float64),
+            np.asarray(meta[names[DEC_FIELD]], dtype=np.float64))
+
+
+def index_path(db_file):
+    """
+    Returns the path of the sidecar index of a database.
+
+    Args:
+        db_file (str): path of the database.
+
+    Returns:
+        str: path of the sidecar file.
+    """
+    return db_file + INDEX_SUFFIX
+
+
+def db_stamp(db_file):
+    """
+    Returns the (mtime, size) pair used to detect changes in a database.
+
+    Args:
+        db_file (str): path of the database.
+
+    Returns:
+        tuple: modification time (ns) and size (bytes) of the file.
+    """
+    st = os.stat(db_file)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def rebuild_index(db_file, meta=None):
+    """
+    Builds the sky index of a database and stores it next to the file.
+
+    If the sidecar cannot be written (e.g. a read-only archive) the index is
+    still returned, it simply won't be reused next time.
+
+    Args:
+        db_file (str): path of the database.
+        meta (ndarray or dict, optional): the `Metadata` table, if already
+            in memory (see `read_radec`).
+
+    Returns:
+        SkyIndex: the new index.
+    """
+    stamp = db_stamp(db_file)
+    if meta is None:
+        with h5py.File(db_file, 'r') as db:
+            meta = db["Metadata"][:]
+    index = SkyIndex.from_metadata(meta, stamp)
+    try:
+        index.save(index_path(db_file))
+    except OSError as e:
+        log.logger.warning(f"Could not write sky index for {db_file}: {e}")
+    return index
+
+
+def load_index(db_file, meta=None):
+    """
+    Returns the sky index of a database, rebuilding it if missing or stale.
+
+    Args:
+        db_file (str): path of the database.
+        meta (ndarray or dict, optional): the `Metadata` table, if already
+            in memory (see `read_radec`).
+
+    Returns:
+        SkyIndex: the index.
+    """
+    path = index_path(db_file)
+    if os.path.isfile(path):
+        try:
+            index = SkyIndex.load(path)
+            if not index.is_stale(db_file):
+                return index
+        except (OSError, KeyError, ValueError) as e:
+            log.logger.warning(f"Discarding unreadable sky index {path}: {e}")
+    return rebuild_index(db_file, meta)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Manage sky indexes of QUBRICS formatted databases.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild = sub.add_parser(
+        "rebuild-index", help="Build (or rebuild) the index of the given databases.")
+    rebuild.add_argument("db_files", nargs="+", metavar="FILE")
+    args = parser.parse_args(argv)
+
+    if args.command == "rebuild-index":
+        for db_file in args.db_files:
+            index = rebuild_index(db_file)
+            print(f"{index_path(db_file)}: {len(index.order)} rows")
+
+
+if __name__ == '__main__':
+    main()
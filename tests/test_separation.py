@@ -0,0 +1,89 @@
+"""
+Checks `sdb.angular_separation` and `sdb.cone_search` against
+`SkyCoord.separation`, the path they replaced.
+
+Usage: python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np  # noqa: E402
+import pytest  # noqa: E402
+from astropy import units as au  # noqa: E402
+from astropy.coordinates import SkyCoord  # noqa: E402
+
+import sdb  # noqa: E402
+
+# agreement required with astropy (arcsec)
+TOLERANCE = 1e-4
+
+
+def skycoord_separation(RA, DEC, ra, dec):
+    center = SkyCoord(ra=RA * au.deg, dec=DEC * au.deg)
+    return center.separation(SkyCoord(ra=ra * au.deg, dec=dec * au.deg)).arcsec
+
+
+def random_positions(rng, n):
+    # uniform on the sphere
+    return rng.uniform(0., 360., n), np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+
+
+def nearby_positions(rng, RA, DEC, n, radius):
+    # within about `radius` (arcsec) of a center, wrapping RA into [0, 360)
+    dec = np.clip(DEC + rng.uniform(-radius, radius, n) / 3600., -90., 90.)
+    ra = (RA + rng.uniform(-radius, radius, n) / 3600.
+          / max(np.cos(np.radians(DEC)), 1e-3)) % 360.
+    return ra, dec
+
+
+CENTERS = {
+    "random": None,
+    "north pole": (123.4, 89.9999),
+    "south pole": (301.2, -89.99),
+    "ra 0": (0.0001, 12.3),
+    "ra 360": (359.9999, -45.6),
+}
+
+
+@pytest.mark.parametrize("name", CENTERS)
+def test_angular_separation(name):
+    rng = np.random.default_rng(sorted(CENTERS).index(name))
+    if CENTERS[name] is None:
+        RA, DEC = random_positions(rng, 1)
+        ra, dec = random_positions(rng, 2000)
+        RA, DEC = RA[0], DEC[0]
+    else:
+        RA, DEC = CENTERS[name]
+        ra, dec = nearby_positions(rng, RA, DEC, 2000, 60.)
+    expected = skycoord_separation(RA, DEC, ra, dec)
+    assert np.allclose(sdb.angular_separation(RA, DEC, ra, dec), expected,
+                       rtol=0., atol=TOLERANCE)
+
+
+def test_angular_separation_elementwise():
+    rng = np.random.default_rng(10)
+    RA, DEC = random_positions(rng, 500)
+    ra, dec = random_positions(rng, 500)
+    expected = SkyCoord(ra=RA * au.deg, dec=DEC * au.deg).separation(
+        SkyCoord(ra=ra * au.deg, dec=dec * au.deg)).arcsec
+    assert np.allclose(sdb.angular_separation(RA, DEC, ra, dec), expected,
+                       rtol=0., atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("name", [_ for _ in CENTERS if CENTERS[_] is not None])
+@pytest.mark.parametrize("chunk_size", [None, 7])
+def test_cone_search(name, chunk_size):
+    rng = np.random.default_rng(20)
+    RA, DEC = CENTERS[name]
+    radius = 30.
+    ra, dec = nearby_positions(rng, RA, DEC, 3000, 2 * radius)
+    expected = skycoord_separation(RA, DEC, ra, dec)
+
+    indices, separations = sdb.cone_search(RA, DEC, radius, ra, dec, chunk_size)
+    # positions on the edge of the cone can go either way
+    edge = np.abs(expected - radius) < TOLERANCE
+    inside = set(np.nonzero(expected < radius)[0])
+    assert set(indices) - set(np.nonzero(edge)[0]) == inside - set(np.nonzero(edge)[0])
+    assert len(inside) > 0
+    assert np.allclose(separations, expected[indices], rtol=0., atol=TOLERANCE)
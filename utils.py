@@ -1,10 +1,37 @@
+import os
 import glob
+import json
+import itertools
+import shutil
 import subprocess
+import threading
+import multiprocessing
+import numpy as np
 from tempfile import mkdtemp
-from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor
+from lazy import lazy_import
+import log
 
 from config import config
 
+# heavy dependencies, imported when first needed
+h5py = lazy_import("h5py")
+au = lazy_import("astropy.units")
+fits = lazy_import("astropy.io.fits")
+table = lazy_import("astropy.table")
+coordinates = lazy_import("astropy.coordinates")
+
+# exports with fewer spectra than this are written serially
+_PARALLEL_EXPORT_MIN = 32
+
+# Astrocook processes launched by the app, with the directory they read from
+_ac_children = []
+# temporary directories created for the exports, and the exports kept for reuse
+_temp_dirs = set()
+_exports = {}
+# exports are registered on worker threads and removed on the main one
+_dirs_lock = threading.Lock()
+
 
 class InvalidInput(Exception):
     pass
@@ -67,6 +94,163 @@ def parse_qid(qid):
     return int(qid)
 
 
+def parse_query(query):
+    """Parse user input for a metadata query.
+
+    The query is a list of "COLUMN=VALUE" constraints separated by ";". The
+    value can be a range "MIN:MAX" (either end can be omitted), a list
+    "A,B,C" of accepted values or a single value, e.g.
+    "ZEM=2.5:3.5; ZEM_SOURCE=SDSS,BOSS".
+
+    Args:
+        query (str): The query.
+
+    Raises:
+        InvalidInput: If the query is invalid.
+
+    Returns:
+        dict: The constraints, see `sdb.QubricsDB.query`.
+    """
+    constraints = {}
+    for item in query.split(";"):
+        if item.strip() == "":
+            continue
+        if item.count("=") != 1:
+            raise InvalidInput(
+                "Please write the query as COLUMN=VALUE pairs separated by ';', e.g. ZEM=2.5:3.5; ZEM_SOURCE=SDSS,BOSS")
+        key, value = (_.strip() for _ in item.split("="))
+        if ":" in value:
+            lo, hi = (_.strip() for _ in value.split(":", 1))
+            if not all(_is_number(_) for _ in (lo, hi) if _ != ""):
+                raise InvalidInput(f"The range of {key} should be numeric.")
+            constraints[key] = (float(lo) if lo != "" else None,
+                                float(hi) if hi != "" else None)
+        elif "," in value:
+            constraints[key] = [_parse_value(_.strip()) for _ in value.split(",")]
+        else:
+            constraints[key] = _parse_value(value)
+    return constraints
+
+
+def _parse_value(value):
+    """
+    Converts a query value to a number, if it is one.
+
+    Args:
+        value (str): The value.
+
+    Returns:
+        int, float or str: The converted value.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return float(value) if _is_number(value) else value
+
+
+def parse_wave_range(wave_min, wave_max):
+    """Parse and validate user input for a wavelength range.
+
+    Args:
+        wave_min (str): Lower end of the range (Angstrom), empty for no limit.
+        wave_max (str): Upper end of the range (Angstrom), empty for no limit.
+
+    Raises:
+        InvalidInput: If the range is invalid.
+
+    Returns:
+        tuple: The (min, max) range as floats, or None if both are empty.
+    """
+    if wave_min == "" and wave_max == "":
+        return None
+    if not all(_is_number(_) for _ in (wave_min, wave_max) if _ != ""):
+        raise InvalidInput(
+            "The wavelength range should be numeric (unit: Angstrom)")
+
+    _min = float(wave_min) if wave_min != "" else 0.
+    _max = float(wave_max) if wave_max != "" else float("inf")
+    if _min >= _max:
+        raise InvalidInput(
+            "The lower end of the wavelength range should be below the upper one.")
+    return _min, _max
+
+
+# column names recognized in target lists, compared case-insensitively
+_TARGET_RA_COLS = ("ra", "rad", "ra_deg", "ra_hms")
+_TARGET_DEC_COLS = ("dec", "decd", "dec_deg", "dec_dms")
+_TARGET_TOL_COLS = ("radius", "match_r", "tol", "sep")
+
+
+def parse_targets(path, tol=""):
+    """Read and validate a target list for a batch search.
+
+    The list can be a CSV or FITS table with RA and DEC columns, either in
+    decimal degrees or sexagesimal ("HH:MM:SS"/"HH MM SS", "DD:MM:SS"/"DD MM SS").
+    A radius column (arcsec) gives a per-row matching radius, otherwise the
+    global `tol` is used.
+
+    Args:
+        path (str): path to the target list.
+        tol (str, optional): global matching radius in arcseconds as a string.
+
+    Raises:
+        InvalidInput: If the target list or the radius is invalid.
+
+    Returns:
+        tuple: right ascension (deg), declination (deg) and matching radius
+            (arcsec) of every target, as float64 arrays.
+    """
+    try:
+        fmt = "ascii.csv" if path.lower().endswith(".csv") else None
+        tbl = table.Table.read(path, format=fmt)
+    except Exception as e:
+        raise InvalidInput(f"Could not read the target list: {e}")
+
+    ra_col = _find_column(tbl, _TARGET_RA_COLS)
+    dec_col = _find_column(tbl, _TARGET_DEC_COLS)
+    if ra_col is None or dec_col is None:
+        raise InvalidInput("The target list needs a RA and a DEC column.")
+
+    tol_col = _find_column(tbl, _TARGET_TOL_COLS)
+    if tol_col is not None:
+        _tol = np.asarray(tbl[tol_col], dtype=np.float64)
+    elif _is_number(tol):
+        _tol = np.full(len(tbl), float(tol))
+    else:
+        raise InvalidInput(
+            "Please provide a matching radius, either globally or as a column of the target list.")
+
+    ra, dec = tbl[ra_col], tbl[dec_col]
+    try:
+        if ra.dtype.kind in "SU":
+            coords = coordinates.SkyCoord(
+                ra=np.char.replace(np.asarray(ra, dtype=str), " ", ":"),
+                dec=np.char.replace(np.asarray(dec, dtype=str), " ", ":"),
+                frame='icrs', unit=(au.hourangle, au.deg))
+            return coords.ra.deg, coords.dec.deg, _tol
+        return np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64), _tol
+    except ValueError as e:
+        raise InvalidInput(f"Invalid coordinates in the target list: {e}")
+
+
+def _find_column(tbl, candidates):
+    """
+    Finds the first column of a table matching one of the given names.
+
+    Args:
+        tbl (Table): the table.
+        candidates (tuple): lowercase names to look for, in order of preference.
+
+    Returns:
+        str: the column name, or None if not found.
+    """
+    names = {name.lower(): name for name in tbl.colnames}
+    for candidate in candidates:
+        if candidate in names:
+            return names[candidate]
+    return None
+
+
 def _valid_pairs(pair_1, pair_2):
     """Check if both RA and DEC pairs are provided.
 
@@ -178,21 +362,81 @@ def _sub_space_for_colon(RA, DEC):
     return RA.replace(" ", ":"), DEC.replace(" ", ":")
 
 
+@log.traced("utils.open_ac")
 def open_ac(path):
     """
     Opens Astrocook on FITS files present in the given path.
 
+    Astrocook runs as a separate process and this returns immediately: the
+    process is tracked, see `reap_ac`.
+
     Args:
         path (str): Path containing the FITS files.
 
+    Returns:
+        subprocess.Popen: the Astrocook process.
+    """
+    proc = subprocess.Popen(["python", config["ac_path"], *glob.glob(path + "/*.fits")],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+    _ac_children.append((proc, path))
+    return proc
+
+
+def reap_ac():
+    """
+    Forgets the Astrocook processes that exited and removes the temporary
+    directories no longer needed by a running process or a kept export.
+
     Returns:
         None.
     """
-    subprocess.run(["python", config["ac_path"], *glob.glob(path + "/*.fits")],
-                   capture_output=True, text=True)
+    _ac_children[:] = [(proc, path) for (proc, path) in _ac_children
+                       if proc.poll() is None]
+    _remove_unused_dirs()
 
 
-def write_and_open(spec, path=None, filename="spec"):
+def release_exports(keep=None):
+    """
+    Stops keeping exported result sets for reuse, e.g. when new results replace
+    them. Their directories are removed once no Astrocook process uses them.
+
+    Args:
+        keep (hashable, optional): key of an export to keep. Defaults to None.
+
+    Returns:
+        None.
+    """
+    with _dirs_lock:
+        for key in list(_exports):
+            if key != keep:
+                del _exports[key]
+    reap_ac()
+
+
+def shutdown_ac():
+    """
+    Removes every temporary directory created by the app, to be called on exit.
+    Astrocook processes still running are left alone.
+
+    Returns:
+        None.
+    """
+    with _dirs_lock:
+        _exports.clear()
+    _ac_children.clear()
+    _remove_unused_dirs()
+
+
+def _remove_unused_dirs():
+    with _dirs_lock:
+        in_use = {path for (_, path) in _ac_children} | set(_exports.values())
+        for path in _temp_dirs - in_use:
+            shutil.rmtree(path, ignore_errors=True)
+            _temp_dirs.discard(path)
+
+
+def write_and_open(spec, path=None, filename="spec", key=None):
     """
     Converts a given spectrum into FITS files, opens Astrocook on them and returns 0.
 
@@ -200,20 +444,99 @@ def write_and_open(spec, path=None, filename="spec"):
         spec (obj): A spectrum object.
         path (str, optional): Path where the FITS files will be stored. If None, a temporary directory is created. Defaults to None.
         filename (str, optional): Name of the FITS files. Defaults to "spec".
+        key (hashable, optional): Identifies the result set: opening the same key again reuses the files already written to a temporary directory. Defaults to None.
 
     Returns:
         int: 0 on successful completion.
 
     """
-    if path is None:
-        path = mkdtemp() + "/"
-    for (n, _) in enumerate(spec[0]):
-        write_spec(_, full_path=path + filename + "_" + str(n) + ".fits")
-
-    open_ac(path)
+    reap_ac()
+    open_ac(write_export(spec, path, filename, key))
     return 0
 
 
+def write_export(spec, path=None, filename="spec", key=None):
+    """
+    Writes the FITS files Astrocook is opened on, see `write_and_open`; it
+    can run on a worker thread, `open_ac` is then called on the main one.
+
+    A temporary directory is only registered once all its files are
+    written: if writing fails (or is cancelled) it is removed.
+
+    Returns:
+        str: the path of the FITS files.
+    """
+    if path is not None:
+        write_specs(spec[0], path, filename)
+        return path
+    if key is not None and os.path.isdir(_exports.get(key, "")):
+        return _exports[key]
+
+    path = mkdtemp() + "/"
+    try:
+        write_specs(spec[0], path, filename)
+    except BaseException:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+    # kept as an export before it can be removed as unused
+    with _dirs_lock:
+        if key is not None:
+            _exports[key] = path
+        _temp_dirs.add(path)
+    return path
+
+
+def _mp_context():
+    # the GUI and the federated searches run threads and keep HDF5 files
+    #  open, forking them can deadlock the workers: start them fresh instead
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+@log.traced("utils.write_specs", rows=len)
+def write_specs(spec_list, path, filename="spec", workers=None, page_size=256):
+    """
+    Writes a list of spectra to FITS files, one per spectrum.
+
+    The spectra are converted and written `page_size` at a time, so they can
+    come from a generator (e.g. `SearchResult.iter_spectra`) without all
+    being in memory. Large pages are written by a pool of processes.
+
+    Args:
+        spec_list (iterable): The spectrum objects.
+        path (str): Directory where the FITS files will be stored, ending with "/".
+        filename (str, optional): Name of the FITS files, numbered from 0. Defaults to "spec".
+        workers (int, optional): Number of processes. Defaults to `export_workers` in the configuration.
+        page_size (int, optional): Number of spectra converted at a time. Defaults to 256.
+
+    Returns:
+        list: The paths of the FITS files.
+    """
+    if workers is None:
+        workers = config.get("export_workers", 1)
+    paths, pool = [], None
+    spec_iter = enumerate(spec_list)
+    try:
+        while True:
+            jobs = [(_spec_arrays(_), path + filename + "_" + str(n) + ".fits")
+                    for (n, _) in itertools.islice(spec_iter, page_size)]
+            if not jobs:
+                break
+            if workers > 1 and len(jobs) >= _PARALLEL_EXPORT_MIN:
+                if pool is None:
+                    pool = ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context())
+                list(pool.map(_write_arrays, *zip(*jobs),
+                              chunksize=max(1, len(jobs) // (4 * workers))))
+            else:
+                for job in jobs:
+                    _write_arrays(*job)
+            paths.extend(full_path for (_, full_path) in jobs)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return paths
+
+
 def write_spec(spec, full_path):
     """
     Writes a given spectrum to a FITS file.
@@ -225,11 +548,101 @@ def write_spec(spec, full_path):
     Returns:
         None.
     """
-    wave = fits.Column(name='wave', format='D',
-                       array=spec.data['wave'].reshape(-1, 1) * spec.units['wave'])
-    flux = fits.Column(name='flux', format='D',
-                       array=spec.data['flux'].reshape(-1, 1) * spec.units['flux'])
-    err = fits.Column(name='err', format='D',
-                      array=spec.data['sig'].reshape(-1, 1) * spec.units['flux'])
-    hdu = fits.BinTableHDU.from_columns([wave, flux, err])
-    hdu.writeto(full_path, overwrite=True)
+    with log.timed("utils.write_spec") as metrics:
+        arrays = _spec_arrays(spec)
+        _write_arrays(arrays, full_path)
+        metrics["rows"] = len(arrays['wave'])
+
+
+@log.traced("utils.write_consolidated")
+def write_consolidated(spec_list, full_path):
+    """
+    Writes a list of spectra to a single file: a multi-extension FITS file
+    (one table per spectrum) or, if `full_path` ends with .hdf5/.h5, an HDF5
+    file with one wave/flux/error dataset per spectrum, as in QUBRICS databases.
+
+    HDF5 files are written one spectrum at a time, so `spec_list` can be a
+    generator; FITS files are assembled in memory first.
+
+    Args:
+        spec_list (iterable): The spectrum objects.
+        full_path (str): Full path of the file.
+
+    Returns:
+        None.
+    """
+    if full_path.endswith((".hdf5", ".h5")):
+        with h5py.File(full_path, 'w') as f:
+            for (n, spec) in enumerate(spec_list):
+                arrays = _spec_arrays(spec)
+                data = np.empty(len(arrays['wave']), dtype=[
+                    ('wave', 'f8'), ('flux', 'f8'), ('error', 'f8')])
+                data['wave'], data['flux'], data['error'] = \
+                    arrays['wave'], arrays['flux'], arrays['err']
+                dset = f.create_dataset("spec_" + str(n), data=data)
+                dset.attrs['wave_unit'] = arrays['units']['wave']
+                dset.attrs['flux_unit'] = arrays['units']['flux']
+    else:
+        hdus = [fits.PrimaryHDU()]
+        for (n, spec) in enumerate(spec_list):
+            hdu = _table_hdu(_spec_arrays(spec))
+            hdu.name = "SPEC_" + str(n)
+            hdus.append(hdu)
+        fits.HDUList(hdus).writeto(full_path, overwrite=True)
+
+
+def write_json(spec_list, fileobj, sources=None):
+    """
+    Writes spectra as JSON lines: one object per spectrum, written (and
+    flushed) as soon as it is converted, so that consumers can stream them.
+
+    Args:
+        spec_list (iterable): The spectrum objects.
+        fileobj (file): A text file open for writing.
+        sources (list, optional): The database of each spectrum, added to its object.
+
+    Returns:
+        int: The number of spectra written.
+    """
+    n = 0
+    for spec in spec_list:
+        arrays = _spec_arrays(spec)
+        record = {name: arrays[name].tolist() for name in ('wave', 'flux', 'err')}
+        record['units'] = arrays['units']
+        if sources is not None:
+            record['source'] = sources[n]
+        fileobj.write(json.dumps(record) + "\n")
+        fileobj.flush()
+        n += 1
+    return n
+
+
+def _spec_arrays(spec):
+    """
+    Extracts the columns of a spectrum as plain float64 arrays, and their units
+    as strings, so that they can be written (or sent to another process)
+    without building Quantity objects.
+
+    Args:
+        spec (obj): A spectrum object.
+
+    Returns:
+        dict: The wave, flux and err arrays and a dictionary of units.
+    """
+    return {'wave': np.asarray(spec.data['wave'], dtype=np.float64).ravel(),
+            'flux': np.asarray(spec.data['flux'], dtype=np.float64).ravel(),
+            'err': np.asarray(spec.data['sig'], dtype=np.float64).ravel(),
+            'units': {'wave': au.Unit(spec.units['wave']).to_string(),
+                      'flux': au.Unit(spec.units['flux']).to_string()}}
+
+
+def _table_hdu(arrays):
+    units = arrays['units']
+    columns = [fits.Column(name=name, format='D', array=arrays[name],
+                           unit=units['wave' if name == 'wave' else 'flux'] or None)
+               for name in ('wave', 'flux', 'err')]
+    return fits.BinTableHDU.from_columns(columns)
+
+
+def _write_arrays(arrays, full_path):
+    _table_hdu(arrays).writeto(full_path, overwrite=True)